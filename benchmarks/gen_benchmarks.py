@@ -1,6 +1,7 @@
 import os
 import numpy
 import shutil
+import scipy.sparse
 from scipy.sparse import random
 from scipy.io import mmread
 
@@ -46,13 +47,14 @@ matrices = [
 
 for m in matrices:
     matrix_path = os.path.join(ss_path, f'{m}.mtx')
-    matrix = mmread(matrix_path)
-    dense_matrixA = matrix.toarray()
-    dense_matrixB = numpy.roll(dense_matrixA, 5, axis=0)
+    # keep the matrices sparse, densifying does not scale to large matrices
+    matrixA = scipy.sparse.csr_matrix(mmread(matrix_path))
+    # same as numpy.roll(A, 5, axis=0) on the dense matrix
+    matrixB = scipy.sparse.vstack([matrixA[-5:], matrixA[:-5]], format='csr')
     folder = f'{m}'
     if os.path.exists(folder):
         shutil.rmtree(folder)
     os.makedirs(folder, exist_ok=True)
-    numpy.save(f'{folder}/A.npy', dense_matrixA)
-    numpy.save(f'{folder}/B.npy', dense_matrixB)
+    scipy.sparse.save_npz(f'{folder}/A.npz', matrixA)
+    scipy.sparse.save_npz(f'{folder}/B.npz', matrixB)
     
\ No newline at end of file
@@ -0,0 +1,225 @@
+import argparse
+import contextlib
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy
+import scipy
+import scipy.sparse
+import sparse
+import yaml
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'tiler_swift'))
+
+from model_opal import Model_Opal
+from run_handler import RunHandler
+from tiler import Tiler
+from util import coo2csf
+
+# Performance harness for the tiler: generates synthetic matrices of
+# several sizes, densities and structures, then times every tiling
+# algorithm, the model, coo2csf and save_tiles separately, and writes
+# everything as json so that results can be compared across versions.
+
+#-------------------------------------------------------------------------
+# Synthetic matrices
+#-------------------------------------------------------------------------
+
+def gen_uniform(size, nnz, rng):
+    rows = rng.integers(0, size, nnz)
+    cols = rng.integers(0, size, nnz)
+    return rows, cols
+
+
+def gen_banded(size, nnz, rng):
+    # non-zeros within a band around the diagonal, wide enough to hold
+    # the requested nnzs
+    bandwidth = max(1, nnz // size)
+    rows = rng.integers(0, size, nnz)
+    cols = numpy.clip(rows + rng.integers(-bandwidth, bandwidth + 1, nnz), 0, size - 1)
+    return rows, cols
+
+
+def gen_block_diagonal(size, nnz, rng, num_blocks=16):
+    # non-zeros uniformly spread over blocks along the diagonal
+    block_size = max(1, size // num_blocks)
+    blocks = rng.integers(0, num_blocks, nnz)
+    rows = numpy.minimum(blocks * block_size + rng.integers(0, block_size, nnz), size - 1)
+    cols = numpy.minimum(blocks * block_size + rng.integers(0, block_size, nnz), size - 1)
+    return rows, cols
+
+
+def gen_power_law(size, nnz, rng, alpha=1.0):
+    # row i gets a share of the non-zeros proportional to (i+1)^-alpha,
+    # rows are shuffled so the heavy rows are not all at the top
+    weights = numpy.arange(1, size + 1, dtype=numpy.float64) ** -alpha
+    weights /= weights.sum()
+    rows = rng.permutation(size)[rng.choice(size, nnz, p=weights)]
+    cols = rng.integers(0, size, nnz)
+    return rows, cols
+
+
+patterns = {
+    'uniform': gen_uniform,
+    'banded': gen_banded,
+    'block_diagonal': gen_block_diagonal,
+    'power_law': gen_power_law,
+}
+
+
+def gen_matrix(pattern, size, density, rng):
+    nnz = int(size * size * density)
+    rows, cols = patterns[pattern](size, nnz, rng)
+    data = rng.random(nnz) + 0.1
+    matrix = scipy.sparse.csr_matrix((data, (rows, cols)), shape=(size, size))
+    matrix.sum_duplicates()
+    return matrix
+
+#-------------------------------------------------------------------------
+# Measurements
+#-------------------------------------------------------------------------
+
+@contextlib.contextmanager
+def quiet():
+    # keep the progress prints out of the timings
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        yield
+
+
+def bench_tiler(config, tensors, algorithm):
+    config = dict(config, tiling_algorithm=algorithm)
+    start = time.perf_counter()
+    model = Model_Opal(config, tensors)
+    model_time = time.perf_counter() - start
+    tiler = Tiler(config=config, tensors=tensors, model=model)
+    start = time.perf_counter()
+    with quiet():
+        results = tiler.tile()
+    tile_time = time.perf_counter() - start
+    # the model calls of the tiling itself, before the estimate of the
+    # whole tiling below adds one per tile
+    model_stats = model.stats()
+    with quiet():
+        estimated_runtime = tiler.estimate_runtime(results)
+    return results, {
+        'algorithm': algorithm,
+        'model_build_s': model_time,
+        'tile_s': tile_time,
+        'model_calls': model_stats['calls'],
+        'model_evaluations': model_stats['evaluations'],
+        'model_batch_calls': model_stats['batch_calls'],
+        'model_batch_rects': model_stats['batch_rects'],
+        'num_tiles': len(results),
+        'estimated_runtime': estimated_runtime,
+    }
+
+
+def bench_coo2csf(tensors, results):
+    start = time.perf_counter()
+    for pair in results:
+        for name, (x, y, w, h) in pair.items():
+            coo2csf(sparse.COO(tensors[name][y:y+h, x:x+w]))
+    return time.perf_counter() - start
+
+
+def bench_save_tiles(config, tensors, results, output_format, jobs):
+    handler = RunHandler()
+    handler._config = dict(config, tile_output_format=output_format)
+    handler._tensors = tensors
+    output_path = tempfile.mkdtemp(prefix='tiler_swift_bench_')
+    try:
+        start = time.perf_counter()
+        with quiet():
+            handler.save_tiles(results, output_path, False, jobs)
+        return time.perf_counter() - start
+    finally:
+        shutil.rmtree(output_path)
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+#-------------------------------------------------------------------------
+# Main
+#-------------------------------------------------------------------------
+
+def main():
+    bench_root = os.path.dirname(os.path.abspath(__file__))
+    p = argparse.ArgumentParser()
+    p.add_argument("-c", "--config-path", type=str, default=os.path.join(bench_root, '..', 'configs', 'config_cgra.yaml'))
+    p.add_argument("-o", "--output-path", type=str, default="perf_results.json")
+    p.add_argument("--sizes", type=int, nargs='+', default=[1000, 5000, 10000, 50000])
+    p.add_argument("--densities", type=float, nargs='+', default=[0.0001, 0.001, 0.01])
+    p.add_argument("--patterns", type=str, nargs='+', default=list(patterns.keys()), choices=list(patterns.keys()))
+    p.add_argument("--algorithms", type=str, nargs='+', default=['simple', 'qtree', 'btree', 'kdtree', 'dp'])
+    p.add_argument("--max-nnz", type=int, default=5000000)
+    p.add_argument("--emit-formats", type=str, nargs='+', default=['text', 'packed'])
+    p.add_argument("-j", "--jobs", type=int, default=1)
+    p.add_argument("--seed", type=int, default=0)
+    opts = p.parse_args()
+
+    with open(opts.config_path, 'r') as f:
+        config = yaml.safe_load(f)
+    names = config['input_matrix_names']
+    rng = numpy.random.default_rng(opts.seed)
+
+    report = {
+        'meta': {
+            'git_commit': git_commit(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'numpy': numpy.__version__,
+            'scipy': scipy.__version__,
+            'machine': platform.machine(),
+            'config': config,
+        },
+        'runs': [],
+    }
+
+    for pattern in opts.patterns:
+        for size in opts.sizes:
+            for density in opts.densities:
+                if size * size * density > opts.max_nnz:
+                    print(f"[perf_suite] skip {pattern} {size}x{size} density {density}: over --max-nnz")
+                    continue
+                start = time.perf_counter()
+                tensors = {name: gen_matrix(pattern, size, density, rng) for name in names}
+                gen_time = time.perf_counter() - start
+                print(f"[perf_suite] {pattern} {size}x{size} density {density}")
+                for algorithm in opts.algorithms:
+                    results, run = bench_tiler(config, tensors, algorithm)
+                    run.update({
+                        'pattern': pattern,
+                        'size': size,
+                        'density': density,
+                        'nnz': {name: int(tensor.nnz) for name, tensor in tensors.items()},
+                        'gen_s': gen_time,
+                        'coo2csf_s': bench_coo2csf(tensors, results),
+                    })
+                    for output_format in opts.emit_formats:
+                        run[f'save_tiles_{output_format}_s'] = bench_save_tiles(config, tensors, results, output_format, opts.jobs)
+                    print(f"[perf_suite]   {algorithm:<8} tiles: {run['num_tiles']:<8} "
+                          f"tile: {run['tile_s']:.3f}s model calls: {run['model_calls']} "
+                          f"batches: {run['model_batch_calls']} ({run['model_batch_rects']} rects)")
+                    report['runs'].append(run)
+                    # write as we go, so a long sweep still leaves results behind
+                    with open(opts.output_path, 'w') as f:
+                        json.dump(report, f, indent=2)
+
+    with open(opts.output_path, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"[perf_suite] results saved to {opts.output_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+import sparse as pydata_sparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "tiler_swift"))
+from util import coo2csf
+
+
+def coo2csf_loop(coo_matrix):
+  # the loop version coo2csf replaced, kept as the reference
+  num_values = len(coo_matrix.data)
+  n_dim = len(coo_matrix.shape)
+
+  crd_dict = {}
+  pos_dict = {}
+  if coo_matrix.nnz == 0:
+    for dim in range(0, n_dim):
+      crd_dict[dim] = [0]
+      pos_dict[dim] = [0, 1]
+    data_array = [0]
+    return pos_dict, crd_dict, data_array
+  else:
+    cur_fiber_length = [num_values]
+    next_level_fiber_length = [1]
+    for dim in range(0, n_dim):
+      idx = 0
+      for fiber_length in cur_fiber_length:
+        pos_count = 1
+        for i in range(0, fiber_length):
+          if (idx == 0):
+            crd_dict[dim] = [coo_matrix.coords[dim][idx]]
+            pos_dict[dim] = [0]
+          else:
+            if (i == 0):
+              crd_dict[dim].append(coo_matrix.coords[dim][idx])
+            else:
+              if (crd_dict[dim][-1] != coo_matrix.coords[dim][idx]):
+                crd_dict[dim].append(coo_matrix.coords[dim][idx])
+                next_level_fiber_length.append(1)
+                pos_count += 1
+              else:
+                next_level_fiber_length[-1] += 1
+          idx += 1
+        pos_dict[dim].append(pos_count + pos_dict[dim][-1])
+        pos_count = 1
+      cur_fiber_length = next_level_fiber_length
+      next_level_fiber_length = [1]
+  return pos_dict, crd_dict, coo_matrix.data
+
+
+def coo2csf_fibers(coo_matrix):
+  # CSF built fiber by fiber from the sorted coordinate tuples, as the
+  # reference for more than two modes: the loop version does not carry
+  # the fiber lengths below the second mode over correctly
+  coords = list(zip(*(np.asarray(c).tolist() for c in coo_matrix.coords)))
+  n_dim = len(coo_matrix.shape)
+  pos_dict = {dim: [0] for dim in range(n_dim)}
+  crd_dict = {dim: [] for dim in range(n_dim)}
+  parents = [()]
+  for dim in range(n_dim):
+    fibers = []
+    for parent in parents:
+      children = sorted({c[:dim + 1] for c in coords if c[:dim] == parent})
+      crd_dict[dim] += [child[dim] for child in children]
+      pos_dict[dim].append(pos_dict[dim][-1] + len(children))
+      fibers += children
+    parents = fibers
+  return pos_dict, crd_dict, coo_matrix.data
+
+
+def assert_same_csf(coo_matrix, reference=coo2csf_loop):
+  pos, crd, vals = coo2csf(coo_matrix)
+  ref_pos, ref_crd, ref_vals = reference(coo_matrix)
+  assert sorted(pos) == sorted(ref_pos)
+  assert sorted(crd) == sorted(ref_crd)
+  for dim in ref_pos:
+    np.testing.assert_array_equal(pos[dim], ref_pos[dim])
+    np.testing.assert_array_equal(crd[dim], ref_crd[dim])
+  np.testing.assert_array_equal(vals, ref_vals)
+
+
+@pytest.mark.parametrize("seed", range(50))
+def test_random_matrices(seed):
+  rng = np.random.default_rng(seed)
+  shape = tuple(int(n) for n in rng.integers(1, 40, size=2))
+  density = rng.choice([0.01, 0.1, 0.5, 1.0])
+  dense = np.where(rng.random(shape) < density, rng.integers(1, 10, size=shape), 0)
+  assert_same_csf(pydata_sparse.COO.from_numpy(dense))
+
+
+@pytest.mark.parametrize("shape", [(5, 7), (3, 4, 5)])
+def test_empty_matrix(shape):
+  assert_same_csf(pydata_sparse.COO.from_numpy(np.zeros(shape)))
+
+
+@pytest.mark.parametrize("shape", [(1, 30), (30, 1), (1, 1)])
+def test_single_row_and_column(shape):
+  rng = np.random.default_rng(0)
+  dense = np.where(rng.random(shape) < 0.5, rng.integers(1, 10, size=shape), 0)
+  dense.flat[0] = 3
+  assert_same_csf(pydata_sparse.COO.from_numpy(dense))
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_3d_coo(seed):
+  rng = np.random.default_rng(seed)
+  shape = tuple(int(n) for n in rng.integers(1, 12, size=3))
+  dense = np.where(rng.random(shape) < 0.2, rng.integers(1, 10, size=shape), 0)
+  dense.flat[0] = 3
+  assert_same_csf(pydata_sparse.COO.from_numpy(dense), reference=coo2csf_fibers)
@@ -3,10 +3,13 @@
 #=========================================================================
 
 import argparse
+import logging
 import os
 import sys
 
 from run_handler import RunHandler
+from service import Tiling_Service, serve
+from tiling_cache import Tiling_Cache, default_cache_dir
 
 #-------------------------------------------------------------------------
 # Main
@@ -21,21 +24,70 @@ def main():
 
   # Parse command line
   p = argparse.ArgumentParser()
-  p.add_argument( "-c", "--config-path", type=str, default=default_config_path )
-  p.add_argument( "-t", "--tensor-path", type=str, default=default_tensor_path )
+  p.add_argument( "-c", "--config-path", type=str, nargs="+", default=[default_config_path] )
+  p.add_argument( "-t", "--tensor-path", type=str, nargs="+", default=[default_tensor_path] )
+  p.add_argument( "-s", "--sweep", action='store_true' )
   p.add_argument( "-o", "--output-path", type=str, default=default_output_path )
   p.add_argument( "-v", "--verbose", action='store_true' )
+  p.add_argument( "-j", "--jobs", type=int, default=1 )
+  p.add_argument( "-i", "--incremental", type=str, default=None )
+  p.add_argument( "--no-cache", action='store_true' )
+  p.add_argument( "--cache-dir", type=str, default=default_cache_dir )
+  p.add_argument( "--cache-size-mb", type=int, default=1024 )
+  p.add_argument( "--cache-tiles", action='store_true' )
+  p.add_argument( "--serve-port", type=int, default=None )
+  p.add_argument( "--serve-socket", type=str, default=None )
+  p.add_argument( "--max-tensor-sets", type=int, default=4 )
+  p.add_argument( "-l", "--log-level", type=str, default="INFO",
+                  choices=["DEBUG", "INFO", "WARNING", "ERROR"] )
 
   opts = p.parse_args()
 
+  # DEBUG also logs every single performance model estimate
+  logging.basicConfig( level=opts.log_level, format="[%(name)s] %(message)s" )
+
+  # tiling results (and with --cache-tiles the tiles too) are reused
+  # across runs with the same tensors and tiling config
+  if opts.no_cache:
+    cache = None
+  else:
+    cache = Tiling_Cache( opts.cache_dir, opts.cache_size_mb, opts.cache_tiles )
+
   # Dispatch
-  rhandler = RunHandler()
-  rhandler.launch(
-    config_path = opts.config_path,
-    tensor_path = opts.tensor_path,
-    output_path = opts.output_path,
-    verbose     = opts.verbose
-  )
+  if opts.serve_port is not None or opts.serve_socket is not None:
+    # tiling service, tiles on request with the tensors kept in memory
+    service = Tiling_Service( cache, opts.max_tensor_sets, opts.config_path[0] )
+    serve( service, port=opts.serve_port, socket_path=opts.serve_socket )
+    return
+
+  rhandler = RunHandler( cache )
+  if opts.sweep or len(opts.config_path) > 1 or len(opts.tensor_path) > 1:
+    # every config x benchmark, into <output-path>/cfg_<config>_bmark_<benchmark>
+    rhandler.sweep(
+      config_paths = opts.config_path,
+      tensor_paths = opts.tensor_path,
+      output_root  = opts.output_path,
+      verbose      = opts.verbose,
+      jobs         = opts.jobs
+    )
+  elif opts.incremental is not None:
+    # re-tile the output in <output-path> where the diff changed it
+    rhandler.launch_incremental(
+      config_path = opts.config_path[0],
+      tensor_path = opts.tensor_path[0],
+      output_path = opts.output_path,
+      diff_path   = opts.incremental,
+      verbose     = opts.verbose,
+      jobs        = opts.jobs
+    )
+  else:
+    rhandler.launch(
+      config_path = opts.config_path[0],
+      tensor_path = opts.tensor_path[0],
+      output_path = opts.output_path,
+      verbose     = opts.verbose,
+      jobs        = opts.jobs
+    )
 
   return
 
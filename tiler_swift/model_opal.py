@@ -1,62 +1,555 @@
+import collections
+import itertools
+import logging
 import numpy
 
+from nnz_index import Nnz_Index, cached_pattern, pattern_union, pattern_intersection, pattern_product
+from tile_writer import tile_formats, tile_footprints
+
+logger = logging.getLogger(__name__)
+
 class Model_Opal:
 
-    def __init__( self, config, tensors ):
+    def __init__( self, config, tensors, index_cache=None, level='mtile' ):
         self._config = config
         self._tensors = tensors
         # why divide by 2.0?
         # because half of the capacity is used for seg
         # unit: number of elements
         self._out_mem_size = config['memory_capacity_mtile'] * 1024 / 2.0 / config['element_size']
+        # storage formats an output tile may take, the one with the
+        # smallest footprint is used (see tile_writer.py); with csf only
+        # the capacity is the half of it above, a dense or bitmap tile
+        # needs no seg/crd data, so denser tiles can be larger
+        self._tile_formats = config.get( 'tile_formats', ['csf'] )
+        for tile_format in self._tile_formats:
+            if tile_format not in tile_formats:
+                raise ValueError( 'Unsupported tile format: ' + tile_format )
+        self._mem_size_bytes = config['memory_capacity_mtile'] * 1024
+        # which memory the tiles are estimated for
+        #   mtile: runtime of a memory tile, bounded by its output nnzs
+        #   glb: off-chip transfer cost of a GLB super-tile, bounded by
+        #        the nnzs of its inputs and output together
+        self._level = level
+        if self._level not in ['mtile', 'glb']:
+            raise ValueError( 'Unsupported memory level: ' + self._level )
+        self._glb_mem_size = config.get( 'memory_capacity_glb', 0 ) * 1024 / 2.0 / config['element_size']
+        # how to estimate the output nnzs from the inputs
+        #   worst_case: assume no overlap for add and full overlap for mul
+        #   exact: count the union (add) or intersection (mul) of the
+        #          input non-zero patterns
+        self._nnz_estimation = config.get( 'nnz_estimation', 'worst_case' )
+        if self._nnz_estimation not in ['worst_case', 'exact']:
+            raise ValueError( 'Unsupported nnz estimation: ' + self._nnz_estimation )
+        # the nnz indexes only depend on the tensors, so models of
+        # different configs over the same tensors can share them
+        self._index_cache = index_cache if index_cache is not None else {}
+        self._build_nnz_index( tensors )
+        self._total_partial_products = None
+        # bounded LRU cache of the estimates, keyed on (operation, rect),
+        # the tilers re-estimate the same rectangles quite often
+        self._cache = collections.OrderedDict()
+        self._cache_size = config.get( 'model_cache_size', 65536 )
+        self.cache_hits = 0
+        self.cache_misses = 0
+        # batched estimates, see estimate_tile_runtimes and
+        # estimate_grid_runtime
+        self.batch_calls = 0
+        self.batch_rects = 0
 
 
-    def _estimate_tile_runtime_elemadd( self, rect ):
-        x, y, width, height = rect
-        # we use the number of output non-zero elements
-        # to estimate the runtime, each non-zero output element
-        # requires one unit of computation time
+    def _cached_index( self, key, build ):
+        if key not in self._index_cache:
+            self._index_cache[key] = build()
+        return self._index_cache[key]
+
+
+    def _build_nnz_index( self, tensors ):
+        # build the non-zero index of every tensor once, so that the
+        # tilers can query the nnzs of any rectangle in constant time
+        self._nnz_index = {}
+        # memory-mapped tensors are read once, see cached_pattern
+        patterns = { tensor_name: cached_pattern( self._index_cache, tensor_name, tensor )
+                     for tensor_name, tensor in tensors.items() }
+        for tensor_name, pattern in patterns.items():
+            self._nnz_index[tensor_name] = self._cached_index( tensor_name, lambda: Nnz_Index( pattern ) )
+        if self._nnz_estimation == 'exact' and self._config['operation'] == 'matmul':
+            left, right = patterns.values()
+            self._product_index = self._cached_index( '__product__',
+                lambda: Nnz_Index( pattern_product( left, right ) ) )
+        elif self._nnz_estimation == 'exact':
+            self._union_index = self._cached_index( '__union__',
+                lambda: Nnz_Index( pattern_union( patterns.values() ) ) )
+            self._intersection_index = self._cached_index( '__intersection__',
+                lambda: Nnz_Index( pattern_intersection( patterns.values() ) ) )
+
+
+    def stats( self ):
+        # number of estimate requests, and how many were actually computed
+        return {
+            'calls': self.cache_hits + self.cache_misses,
+            'evaluations': self.cache_misses,
+            'cache_hits': self.cache_hits,
+            'cache_misses': self.cache_misses,
+            'batch_calls': self.batch_calls,
+            'batch_rects': self.batch_rects,
+        }
+
+
+    def invalidate( self, tensors=None ):
+        # drop every cached estimate, must be called whenever the tensors
+        # change; passing the new tensors also rebuilds the nnz indexes
+        if tensors is not None:
+            self._tensors = tensors
+            # a fresh index cache, the old one may be shared with other models
+            self._index_cache = {}
+            self._build_nnz_index( tensors )
+            self._total_partial_products = None
+        self._cache.clear()
+
+
+    def count_nnz( self, tensor_name, rect ):
+        return self._nnz_index[tensor_name].count( rect )
+
+
+    def _estimate_output_nnz_elemadd( self, rect ):
         output_nnzs = 0
-        for _, tensor in self._tensors.items():
-            # for elementwise-add, the worst case is that
-            # all input nnzs do not overlap, so we need to
-            # add up all input nnzs
-            output_nnzs += numpy.count_nonzero( tensor[y:y+height, x:x+width] )
-        if output_nnzs > self._out_mem_size:
-            # we use negative value to indicate that the tiling is infeasible
-            print(f"[Model_Opal] output_nnzs({output_nnzs}) > out_mem_size({self._out_mem_size})")
-            return -1
+        if self._nnz_estimation == 'exact':
+            # the output is non-zero wherever any input is non-zero
+            output_nnzs = self._union_index.count( rect )
         else:
-            print(f"[Model_Opal] output_nnzs({output_nnzs}) fits")
-            return self._config['tile_overhead'] + output_nnzs
-        
-        
-    def _estimate_tile_runtime_elemmul( self, rect ):
-        x, y, width, height = rect
+            for _, nnz_index in self._nnz_index.items():
+                # for elementwise-add, the worst case is that
+                # all input nnzs do not overlap, so we need to
+                # add up all input nnzs
+                output_nnzs += nnz_index.count( rect )
+        return output_nnzs
+
+
+    def _estimate_output_nnz_elemmul( self, rect ):
+        output_nnzs = 0
+        if self._nnz_estimation == 'exact':
+            # the output is non-zero only where all inputs are non-zero
+            output_nnzs = self._intersection_index.count( rect )
+        else:
+            for _, nnz_index in self._nnz_index.items():
+                # for elementwise-mult, the worst case is that
+                # all input nnzs overlap, so the output size is
+                # the maximum of all input sizes
+                output_nnzs = max( output_nnzs, nnz_index.count( rect ) )
+        return output_nnzs
+
+
+    def estimate_output_nnz( self, rect, operation=None ):
+        if operation is None:
+            operation = self._config['operation']
+        if operation == 'elementwise-add':
+            return self._estimate_output_nnz_elemadd( rect )
+        elif operation == 'elementwise-mul':
+            return self._estimate_output_nnz_elemmul( rect )
+        else:
+            raise ValueError( 'Unsupported operation: ' + operation )
+
+
+    def estimate_grid_runtime( self, x_edges, y_edges, operation=None ):
+        # vectorized estimate of every tile of a regular grid, the edges
+        # span the whole tensor or a region of it; returns a (rows, cols)
+        # array of runtimes with -1 for the tiles that do not fit
+        if operation is None:
+            operation = self._config['operation']
+        # counted as a batch of the tiles of the grid
+        self.batch_calls += 1
+        self.batch_rects += ( len( x_edges ) - 1 ) * ( len( y_edges ) - 1 )
+        if operation == 'elementwise-add':
+            if self._nnz_estimation == 'exact':
+                output_nnzs = self._union_index.grid_counts( x_edges, y_edges )
+            else:
+                output_nnzs = sum( nnz_index.grid_counts( x_edges, y_edges )
+                                   for _, nnz_index in self._nnz_index.items() )
+        elif operation == 'elementwise-mul':
+            if self._nnz_estimation == 'exact':
+                output_nnzs = self._intersection_index.grid_counts( x_edges, y_edges )
+            else:
+                output_nnzs = numpy.maximum.reduce( [ nnz_index.grid_counts( x_edges, y_edges )
+                                                      for _, nnz_index in self._nnz_index.items() ] )
+        else:
+            raise ValueError( 'Unsupported operation: ' + operation )
+        if self._level == 'glb':
+            input_nnzs = sum( nnz_index.grid_counts( x_edges, y_edges )
+                              for _, nnz_index in self._nnz_index.items() )
+            return self._transfer_cost_from_nnz( input_nnzs + output_nnzs )
+        areas = numpy.outer( numpy.diff( y_edges ), numpy.diff( x_edges ) )
+        runtimes = self._runtime_from_output( output_nnzs, areas )
+        if self._nnz_estimation == 'exact':
+            input_nnzs = [ nnz_index.grid_counts( x_edges, y_edges ) for _, nnz_index in self._nnz_index.items() ]
+            runtimes = numpy.where( self._inputs_fit( input_nnzs, areas ), runtimes, -1 )
+        return runtimes
+
+
+    def _nnzs_per_element( self, operation ):
+        # the most nnzs (those of grid_bounds) an estimate gives per element
+        # of a tile: worst-case add counts the non-zeros of every input
+        output_per_element = 1
+        if operation == 'elementwise-add' and self._nnz_estimation != 'exact':
+            output_per_element = len( self._nnz_index )
+        if self._level == 'glb':
+            return len( self._nnz_index ) + output_per_element
+        return output_per_element
+
+
+    def grid_bounds( self, rect, operation=None ):
+        # bounds on every grid of tiles covering rect, for the tilers to
+        # skip the grids that cannot win; returns (per_tile, fixed, nnzs):
+        #   - no grid of n tiles has a total estimate below
+        #     per_tile * n + fixed
+        #   - the tiles of any grid hold at least nnzs together, and each
+        #     tile at most tile_capacity of its area to fit
+        # the output nnzs of the tiles add up to at least those of rect
+        # (exactly, but for worst-case mul where the max of the sums is at
+        # most the sum of the maxima)
+        if operation is None:
+            operation = self._config['operation']
+        output_nnzs = self.estimate_output_nnz( rect, operation )
+        if self._level == 'glb':
+            nnzs = output_nnzs + sum( nnz_index.count( rect ) for _, nnz_index in self._nnz_index.items() )
+            return ( self._config.get( 'glb_transfer_overhead', 0 ),
+                     self._config.get( 'glb_transfer_cost_per_nnz', 1 ) * nnzs, nnzs )
+        # every tile costs its overhead, plus at least its nnzs in csf or
+        # bitmap, and its elements times dense_cost_per_element in dense
+        cost_per_nnz = 1
+        if 'dense' in self._tile_formats:
+            cost_per_nnz = min( 1, self._config.get( 'dense_cost_per_element', 1 ) / self._nnzs_per_element( operation ) )
+        return ( self._config['tile_overhead'], cost_per_nnz * output_nnzs, output_nnzs )
+
+
+    def tile_capacity( self, area, operation=None ):
+        # the most nnzs (those of grid_bounds) a tile of the given area can
+        # hold and still fit; no more than it has elements for, which is
+        # all a dense tile is bounded by
+        if operation is None:
+            operation = self._config['operation']
+        capacity = area * self._nnzs_per_element( operation )
+        if self._level == 'glb':
+            return min( capacity, self._glb_mem_size )
+        fit = 0
+        empty = tile_footprints( 0, area, self._config['element_size'] )
+        full = tile_footprints( 1, area, self._config['element_size'] )
+        for tile_format in self._tile_formats:
+            per_nnz = int( full[tile_format] - empty[tile_format] )
+            if per_nnz == 0:
+                if empty[tile_format] <= self._mem_size_bytes:
+                    fit = capacity
+            else:
+                fit = max( fit, ( self._mem_size_bytes - int( empty[tile_format] ) ) // per_nnz )
+        return min( capacity, fit )
+
+
+    def _transfer_cost_from_nnz( self, nnzs ):
+        # every nnz of the inputs and of the output goes through the GLB
+        # once, plus a fixed cost to set up the transfers of a super-tile;
+        # -1 when the super-tile does not fit in the GLB (also for arrays)
+        transfer_cost = self._config.get( 'glb_transfer_overhead', 0 ) \
+                      + self._config.get( 'glb_transfer_cost_per_nnz', 1 ) * nnzs
+        return numpy.where( nnzs > self._glb_mem_size, -1, transfer_cost )
+
+
+    def estimate_transfer_cost( self, rect, operation=None ):
+        # off-chip transfer cost of the GLB super-tile rect
+        input_nnzs = sum( nnz_index.count( rect ) for _, nnz_index in self._nnz_index.items() )
+        output_nnzs = self.estimate_output_nnz( rect, operation )
+        return int( self._transfer_cost_from_nnz( input_nnzs + output_nnzs ) )
+
+
+    def _runtime_from_output( self, output_nnzs, areas ):
+        # runtime of output tiles (scalars or arrays) in the storage format
+        # they take, -1 where that format does not fit in the memory tile
+        #   csf:    one unit of computation time per non-zero
+        #   bitmap: one per non-zero, plus one per bitmap_scan_width bits
+        #   dense:  dense_cost_per_element per element
+        output_nnzs = numpy.asarray( output_nnzs, dtype=numpy.int64 )
+        areas = numpy.asarray( areas, dtype=numpy.int64 )
+        footprints = tile_footprints( output_nnzs, areas, self._config['element_size'] )
+        costs = {
+            'csf': output_nnzs,
+            'bitmap': output_nnzs - ( -areas // self._config.get( 'bitmap_scan_width', 64 ) ),
+            'dense': areas * self._config.get( 'dense_cost_per_element', 1 ),
+        }
+        footprint = footprints[self._tile_formats[0]]
+        cost = costs[self._tile_formats[0]]
+        for tile_format in self._tile_formats[1:]:
+            smaller = footprints[tile_format] < footprint
+            footprint = numpy.where( smaller, footprints[tile_format], footprint )
+            cost = numpy.where( smaller, costs[tile_format], cost )
+        return numpy.where( footprint > self._mem_size_bytes, -1, self._config['tile_overhead'] + cost )
+
+
+    def _inputs_fit( self, input_nnzs, areas ):
+        # with exact nnz estimation the output nnzs no longer bound those
+        # of the inputs (the intersection of disjoint patterns is empty),
+        # so every input tile has to fit in the memory tile on its own
+        return self._runtime_from_output( numpy.maximum.reduce( input_nnzs ), areas ) >= 0
+
+
+    def _runtime_from_output_nnz( self, output_nnzs, area ):
         # we use the number of output non-zero elements
         # to estimate the runtime, each non-zero output element
-        # requires one unit of computation time
-        output_nnzs = 0
-        for _, tensor in self._tensors.items():
-            # for elementwise-mult, the worst case is that
-            # all input nnzs overlap, so the output size is
-            # the maximum of all input sizes
-            output_nnzs = max( output_nnzs,
-                               numpy.count_nonzero( tensor[y:y+height, x:x+width] ) )
-        if output_nnzs > self._out_mem_size:
+        # requires one unit of computation time (in csf)
+        runtime = int( self._runtime_from_output( output_nnzs, area ) )
+        if runtime < 0:
             # we use negative value to indicate that the tiling is infeasible
-            print(f"[Model_Opal] output_nnzs({output_nnzs}) > out_mem_size({self._out_mem_size})")
-            return -1
+            logger.debug( "output_nnzs(%d) of area %d do not fit in %s bytes", output_nnzs, area, self._mem_size_bytes )
+        else:
+            logger.debug( "output_nnzs(%d) fits", output_nnzs )
+        return runtime
+
+
+    def _estimate_tile_runtime_elemadd( self, rect ):
+        return self._runtime_from_output_nnz( self._estimate_output_nnz_elemadd( rect ), rect[2] * rect[3] )
+
+
+    def _estimate_tile_runtime_elemmul( self, rect ):
+        return self._runtime_from_output_nnz( self._estimate_output_nnz_elemmul( rect ), rect[2] * rect[3] )
+
+
+    def _estimate_tile_runtime( self, rect, operation ):
+        if self._level == 'glb':
+            # the tilers minimize the estimate, at the GLB level that is
+            # the off-chip transfer cost
+            return self.estimate_transfer_cost( rect, operation )
+        if operation == 'elementwise-add':
+            tile_runtime = self._estimate_tile_runtime_elemadd( rect )
+        elif operation == 'elementwise-mul':
+            tile_runtime = self._estimate_tile_runtime_elemmul( rect )
         else:
-            print(f"[Model_Opal] output_nnzs({output_nnzs}) fits")
-            return self._config['tile_overhead'] + output_nnzs
+            raise ValueError( 'Unsupported operation: ' + operation )
+        if tile_runtime >= 0 and self._nnz_estimation == 'exact':
+            input_nnzs = [ nnz_index.count( rect ) for _, nnz_index in self._nnz_index.items() ]
+            if not self._inputs_fit( input_nnzs, rect[2] * rect[3] ):
+                logger.debug( "input_nnzs(%s) do not fit in %s bytes", input_nnzs, self._mem_size_bytes )
+                return -1
+        return tile_runtime
+
 
+    def estimate_tile_runtime( self, rect, operation=None ):
+        if operation is None:
+            operation = self._config['operation']
+        key = ( operation, tuple( rect ) )
+        if key in self._cache:
+            self.cache_hits += 1
+            self._cache.move_to_end( key )
+            return self._cache[key]
+        self.cache_misses += 1
+        tile_runtime = self._estimate_tile_runtime( rect, operation )
+        if self._cache_size > 0:
+            self._cache[key] = tile_runtime
+            if len( self._cache ) > self._cache_size:
+                self._cache.popitem( last=False )
+        return tile_runtime
 
-    def estimate_tile_runtime( self, rect ):
-        if self._config['operation'] == 'elementwise-add':
-            return self._estimate_tile_runtime_elemadd( rect )
-        elif self._config['operation'] == 'elementwise-mul':
-            return self._estimate_tile_runtime_elemmul( rect )
+
+    def estimate_tile_runtimes( self, rects, operation=None ):
+        # batched estimate_tile_runtime: the estimates of an (N, 4) array
+        # of rects (e.g. a whole level of a tiling tree) in one vectorized
+        # pass, -1 for the ones that do not fit; bypasses the LRU cache
+        if operation is None:
+            operation = self._config['operation']
+        rects = numpy.asarray( rects, dtype=numpy.int64 ).reshape( -1, 4 )
+        self.batch_calls += 1
+        self.batch_rects += len( rects )
+        input_nnzs = [ nnz_index.counts( rects ) for _, nnz_index in self._nnz_index.items() ]
+        if operation == 'elementwise-add':
+            if self._nnz_estimation == 'exact':
+                output_nnzs = self._union_index.counts( rects )
+            else:
+                output_nnzs = sum( input_nnzs )
+        elif operation == 'elementwise-mul':
+            if self._nnz_estimation == 'exact':
+                output_nnzs = self._intersection_index.counts( rects )
+            else:
+                output_nnzs = numpy.maximum.reduce( input_nnzs )
         else:
-            raise ValueError( 'Unsupported operation: ' + self._config['operation'] )
-        
+            raise ValueError( 'Unsupported operation: ' + operation )
+        if self._level == 'glb':
+            return self._transfer_cost_from_nnz( sum( input_nnzs ) + output_nnzs )
+        areas = rects[:, 2] * rects[:, 3]
+        runtimes = self._runtime_from_output( output_nnzs, areas )
+        if self._nnz_estimation == 'exact':
+            runtimes = numpy.where( self._inputs_fit( input_nnzs, areas ), runtimes, -1 )
+        return runtimes
+
+
+    #---------------------------------------------------------------------
+    # matmul: C (M x N) = A (M x K) @ B (K x N)
+    #---------------------------------------------------------------------
+    # a tile is a block of each dimension, A gets the rect [k, m, tk, tm]
+    # and B the rect [n, k, tn, tk]; the A, B and C blocks of a tile each
+    # need to fit in a memory tile, C over the whole K as it accumulates
+    # the partial products of every K block. The runtime of a tile is
+    # tile_overhead plus its partial products, and loading a block into
+    # a memory tile costs matmul_load_cost_per_nnz per nnz; a block stays
+    # in its memory tile until the next tile needs another block of the
+    # same tensor, so the loop order of the tiles decides the reuse
+
+    def _matmul_operands( self ):
+        # names of A and B, in the input_matrix_names order
+        left, right = self._nnz_index.keys()
+        return left, right
+
+
+    def _matmul_partial_products( self, m_edges, n_edges, k_range=None ):
+        # partial products of every block of C, from the column nnz
+        # profiles of the block rows of A and the row nnz profiles of the
+        # block columns of B, over the whole K or only over k_range
+        left, right = self._matmul_operands()
+        if k_range is None:
+            k_range = ( 0, self._tensors[left].shape[1] )
+        k_edges = numpy.arange( k_range[0], k_range[1] + 1 )
+        # profiles of sparse tensors are mostly zeros
+        a_profile = self._nnz_index[left].sparse_grid_counts( k_edges, m_edges )
+        b_profile = self._nnz_index[right].sparse_grid_counts( n_edges, k_edges )
+        return ( a_profile @ b_profile ).toarray()
+
+
+    def estimate_matmul_output_grid( self, m_edges, n_edges ):
+        # output nnzs of every block of C, a (M blocks, N blocks) array
+        if self._nnz_estimation == 'exact':
+            return self._product_index.grid_counts( n_edges, m_edges )
+        # worst case: every partial product lands on a different output,
+        # up to the size of the block
+        area = numpy.outer( numpy.diff( m_edges ), numpy.diff( n_edges ) )
+        return numpy.minimum( area, self._matmul_partial_products( m_edges, n_edges ) )
+
+
+    def fits( self, nnzs ):
+        # whether blocks of these nnzs all fit in a memory tile
+        return bool( numpy.all( numpy.asarray( nnzs ) <= self._out_mem_size ) )
+
+
+    def total_partial_products( self ):
+        # partial products of the whole product, whatever the tiling
+        if self._total_partial_products is None:
+            left, right = self._matmul_operands()
+            m = self._tensors[left].shape[0]
+            n = self._tensors[right].shape[1]
+            self._total_partial_products = int( self._matmul_partial_products( [0, m], [0, n] ).sum() )
+        return self._total_partial_products
+
+
+    def _matmul_loads( self, order, blocks, trips ):
+        # how many times every block of a tensor indexed by the loops in
+        # `blocks` is loaded when the tiles are visited in the nested loop
+        # `order` (outer to inner): once, times the trip counts of the
+        # loops it does not depend on outside its innermost varying loop
+        varying = [ order.index( loop ) for loop in blocks if trips[loop] > 1 ]
+        if not varying:
+            return 1
+        loads = 1
+        for loop in order[:max( varying )]:
+            if loop not in blocks:
+                loads *= trips[loop]
+        return loads
+
+
+    def estimate_matmul_grid_runtime( self, m_edges, n_edges, k_edges, output_nnzs=None ):
+        # estimated runtime of the grid of tiles given by the M, N and K
+        # edges, with the loop order (outer to inner, e.g. 'mkn') that
+        # needs the least loads; (-1, None) if any block does not fit
+        left, right = self._matmul_operands()
+        a_nnzs = self._nnz_index[left].grid_counts( k_edges, m_edges )
+        b_nnzs = self._nnz_index[right].grid_counts( n_edges, k_edges )
+        if output_nnzs is None:
+            output_nnzs = self.estimate_matmul_output_grid( m_edges, n_edges )
+        if not ( self.fits( a_nnzs ) and self.fits( b_nnzs ) and self.fits( output_nnzs ) ):
+            return -1, None
+        trips = { 'm': len( m_edges ) - 1, 'n': len( n_edges ) - 1, 'k': len( k_edges ) - 1 }
+        compute = trips['m'] * trips['n'] * trips['k'] * self._config['tile_overhead'] \
+                + self.total_partial_products()
+        load_cost = self._config.get( 'matmul_load_cost_per_nnz', 1 )
+        best = ( -1, None )
+        for order in itertools.permutations( 'mnk' ):
+            order = ''.join( order )
+            loads = self._matmul_loads( order, 'mk', trips ) * int( a_nnzs.sum() ) \
+                  + self._matmul_loads( order, 'kn', trips ) * int( b_nnzs.sum() ) \
+                  + self._matmul_loads( order, 'mn', trips ) * int( output_nnzs.sum() )
+            runtime = compute + load_cost * loads
+            if best[1] is None or runtime < best[0]:
+                best = ( runtime, order )
+        return best
+
+
+    def _matmul_profile( self, name, rect, axis ):
+        # nnzs of every column ('x') or row ('y') of rect in a tensor
+        x, y, width, height = rect
+        if axis == 'x':
+            return self._nnz_index[name].grid_counts( numpy.arange( x, x + width + 1 ), [y, y + height] )[0]
+        return self._nnz_index[name].grid_counts( [x, x + width], numpy.arange( y, y + height + 1 ) )[:, 0]
+
+
+    def _matmul_tile_costs( self, results ):
+        # compute time and blocks (rect and nnzs of A, B and C) of every
+        # matmul tile in turn, or None for a tile whose blocks do not fit;
+        # the nnz profiles of the blocks are shared by many tiles, so they
+        # are computed once per block
+        left, right = self._matmul_operands()
+        k_length = self._tensors[left].shape[1]
+        profiles = {}
+        def profile( name, rect, axis ):
+            key = ( name, rect, axis )
+            if key not in profiles:
+                profiles[key] = self._matmul_profile( name, rect, axis )
+            return profiles[key]
+        output_nnzs = {}
+        for pair in results:
+            a_rect = tuple( pair[left] )
+            b_rect = tuple( pair[right] )
+            k, m, tk, tm = a_rect
+            n, _, tn, _ = b_rect
+            c_rect = ( n, m, tn, tm )
+            if c_rect not in output_nnzs:
+                if self._nnz_estimation == 'exact':
+                    output_nnzs[c_rect] = self._product_index.count( c_rect )
+                else:
+                    partial_products = numpy.dot( profile( left, ( 0, m, k_length, tm ), 'x' ),
+                                                  profile( right, ( n, 0, tn, k_length ), 'y' ) )
+                    output_nnzs[c_rect] = int( min( tm * tn, partial_products ) )
+            blocks = { left: ( a_rect, int( profile( left, a_rect, 'x' ).sum() ) ),
+                       right: ( b_rect, int( profile( right, b_rect, 'y' ).sum() ) ),
+                       None: ( c_rect, output_nnzs[c_rect] ) }
+            if not self.fits( [ nnz for _, nnz in blocks.values() ] ):
+                yield None
+                continue
+            yield self._config['tile_overhead'] \
+                + int( numpy.dot( profile( left, a_rect, 'x' ), profile( right, b_rect, 'y' ) ) ), blocks
+
+
+    def estimate_matmul_runtime( self, results ):
+        # estimated runtime of a sequence of matmul tiles, with the blocks
+        # loaded whenever they differ from those of the previous tile, or
+        # -1 if any block does not fit
+        load_cost = self._config.get( 'matmul_load_cost_per_nnz', 1 )
+        resident = {}
+        runtime = 0
+        for tile_cost in self._matmul_tile_costs( results ):
+            if tile_cost is None:
+                return -1
+            compute, blocks = tile_cost
+            runtime += compute
+            for name, ( rect, nnz ) in blocks.items():
+                if resident.get( name ) != rect:
+                    runtime += load_cost * nnz
+                    resident[name] = rect
+        return runtime
+
+
+    def estimate_matmul_tile_runtimes( self, results ):
+        # estimated runtime of every matmul tile on its own, all of its
+        # blocks loaded, -1 for the tiles that do not fit
+        load_cost = self._config.get( 'matmul_load_cost_per_nnz', 1 )
+        runtimes = []
+        for tile_cost in self._matmul_tile_costs( results ):
+            if tile_cost is None:
+                runtimes.append( -1 )
+                continue
+            compute, blocks = tile_cost
+            runtimes.append( compute + load_cost * sum( nnz for _, nnz in blocks.values() ) )
+        return runtimes
@@ -0,0 +1,291 @@
+import numpy
+import scipy.sparse
+
+class Nnz_Index:
+
+    def __init__( self, tensor ):
+        self._height, self._width = tensor.shape
+        if isinstance( tensor, numpy.memmap ):
+            # a memory-mapped tensor may not fit in memory, and neither
+            # would its summed-area table, so index its non-zeros
+            tensor = stream_pattern( tensor )
+        if scipy.sparse.issparse( tensor ):
+            # a summed-area table is rows x cols, which defeats keeping
+            # the tensor sparse, so sparse tensors are indexed by their
+            # row-major linear keys instead (memory scales with the nnzs)
+            csr = scipy.sparse.csr_matrix( tensor )
+            csr.sum_duplicates()
+            csr.eliminate_zeros()
+            self._indptr = csr.indptr.astype( numpy.int64 )
+            self._cols = csr.indices.astype( numpy.int64 )
+            self._rows = numpy.repeat( numpy.arange( self._height, dtype=numpy.int64 ), numpy.diff( self._indptr ) )
+            self._keys = self._rows * self._width + self._cols
+            self._sat = None
+            # see _column_strips
+            self._last_x_edges = None
+            self._strips = None
+        else:
+            # summed-area table of the non-zero pattern, padded with a
+            # leading row and column of zeros, so that the number of
+            # non-zeros in any rectangle takes four lookups instead of
+            # a count over the whole rectangle
+            mask = tensor != 0
+            # int32 is enough unless the tensor has 2^31 elements or more
+            dtype = numpy.int32 if mask.size < 2**31 else numpy.int64
+            self._sat = numpy.zeros( (self._height + 1, self._width + 1), dtype=dtype )
+            numpy.cumsum( mask, axis=0, dtype=dtype, out=self._sat[1:, 1:] )
+            numpy.cumsum( self._sat[1:, 1:], axis=1, out=self._sat[1:, 1:] )
+
+
+    def _count_sparse( self, x0, y0, x1, y1 ):
+        begin = self._indptr[y0]
+        end = self._indptr[y1]
+        if x0 == 0 and x1 == self._width:
+            # full-width band, the row pointers already have the answer
+            return int( end - begin )
+        num_rows = y1 - y0
+        if end - begin <= num_rows:
+            # few non-zeros in the band, test their columns directly
+            cols = self._cols[begin:end]
+            return int( numpy.count_nonzero( (cols >= x0) & (cols < x1) ) )
+        # otherwise binary search the column range within every row
+        keys = self._keys[begin:end]
+        row_base = numpy.arange( y0, y1, dtype=numpy.int64 ) * self._width
+        lo = numpy.searchsorted( keys, row_base + x0 )
+        hi = numpy.searchsorted( keys, row_base + x1 )
+        return int( (hi - lo).sum() )
+
+
+    def count( self, rect ):
+        x, y, width, height = rect
+        # clip the rectangle to the tensor, same as numpy slicing does
+        x0 = min( max( x, 0 ), self._width )
+        y0 = min( max( y, 0 ), self._height )
+        x1 = min( max( x + width, x0 ), self._width )
+        y1 = min( max( y + height, y0 ), self._height )
+        if self._sat is None:
+            return self._count_sparse( x0, y0, x1, y1 )
+        sat = self._sat
+        return int( sat[y1, x1] - sat[y0, x1] - sat[y1, x0] + sat[y0, x0] )
+
+
+    def _count_rows( self, x0, y0, x1, y1 ):
+        # binary search the column range of every rectangle within every
+        # one of its rows, all the rows of all the rectangles at once
+        num_rows = y1 - y0
+        starts = numpy.cumsum( num_rows ) - num_rows
+        rows = numpy.arange( num_rows.sum(), dtype=numpy.int64 ) + numpy.repeat( y0 - starts, num_rows )
+        row_base = rows * self._width
+        lo = numpy.searchsorted( self._keys, row_base + numpy.repeat( x0, num_rows ) )
+        hi = numpy.searchsorted( self._keys, row_base + numpy.repeat( x1, num_rows ) )
+        return numpy.add.reduceat( hi - lo, starts )
+
+
+    def _count_band( self, x0, y0, x1, y1 ):
+        # rectangles over the same band of rows share a single pass over
+        # its non-zeros: bin their columns by the rectangle edges, and the
+        # nnzs left of every edge come out of a cumulative sum
+        cols = self._cols[self._indptr[y0]:self._indptr[y1]]
+        edges = numpy.unique( numpy.concatenate( ( x0, x1 ) ) )
+        left_of = numpy.cumsum( numpy.bincount( numpy.searchsorted( edges, cols, side='right' ),
+                                                minlength=len( edges ) + 1 ) )
+        return left_of[numpy.searchsorted( edges, x1 )] - left_of[numpy.searchsorted( edges, x0 )]
+
+
+    def _counts_sparse( self, x0, y0, x1, y1 ):
+        # full-width bands, the row pointers already have the answer
+        counts = self._indptr[y1] - self._indptr[y0]
+        partial = numpy.flatnonzero( ( ( x0 > 0 ) | ( x1 < self._width ) ) & ( y1 > y0 ) )
+        if len( partial ) == 0:
+            return counts
+        # group the rectangles by band of rows, a band shared by enough of
+        # them (e.g. the nodes of a tree level side by side) is cheaper to
+        # count in one pass than with a binary search per row and rectangle
+        bands, inverse, sizes = numpy.unique( y0[partial] * ( self._height + 1 ) + y1[partial],
+                                              return_inverse=True, return_counts=True )
+        inverse = inverse.reshape( -1 )
+        band_y0 = bands // ( self._height + 1 )
+        band_y1 = bands % ( self._height + 1 )
+        band_nnzs = self._indptr[band_y1] - self._indptr[band_y0]
+        shared = ( sizes >= 8 ) & ( band_nnzs < 8 * sizes * ( band_y1 - band_y0 ) )
+        by_rows = partial[~shared[inverse]]
+        if len( by_rows ):
+            counts[by_rows] = self._count_rows( x0[by_rows], y0[by_rows], x1[by_rows], y1[by_rows] )
+        order = numpy.argsort( inverse, kind='stable' )
+        ends = numpy.cumsum( sizes )
+        for band in numpy.flatnonzero( shared ):
+            members = partial[order[ends[band] - sizes[band]:ends[band]]]
+            counts[members] = self._count_band( x0[members], band_y0[band], x1[members], band_y1[band] )
+        return counts
+
+
+    def counts( self, rects ):
+        # nnzs of every rectangle of an (N, 4) array of [x, y, w, h], same
+        # as count on each of them, in a single vectorized pass
+        rects = numpy.asarray( rects, dtype=numpy.int64 ).reshape( -1, 4 )
+        x0 = numpy.clip( rects[:, 0], 0, self._width )
+        y0 = numpy.clip( rects[:, 1], 0, self._height )
+        x1 = numpy.minimum( numpy.maximum( rects[:, 0] + rects[:, 2], x0 ), self._width )
+        y1 = numpy.minimum( numpy.maximum( rects[:, 1] + rects[:, 3], y0 ), self._height )
+        if self._sat is None:
+            return self._counts_sparse( x0, y0, x1, y1 )
+        sat = self._sat
+        return sat[y1, x1].astype( numpy.int64 ) - sat[y0, x1] - sat[y1, x0] + sat[y0, x0]
+
+
+    def _blocks( self, edges, positions ):
+        # block of every position, blocks of a regular grid (all but the
+        # last block of the same size, e.g. single rows/columns for the
+        # nnz profiles of the matmul model) need no search
+        steps = numpy.diff( edges[:-1] )
+        if len( edges ) > 2 and numpy.all( steps == edges[1] - edges[0] ) and edges[-1] - edges[-2] <= edges[1] - edges[0]:
+            return ( positions - edges[0] ) // ( edges[1] - edges[0] )
+        return numpy.searchsorted( edges, positions, side='right' ) - 1
+
+
+    def _column_strips( self, x_edges ):
+        # nnzs of every column block between x_edges above every row, a
+        # (rows + 1, blocks) array, so that grids over the same column
+        # edges (e.g. every tile height for a tile width) take a difference
+        # of two of its rows per block; built when the same column edges
+        # come twice in a row, and only the last one is kept
+        key = x_edges.tobytes()
+        strips = self._strips
+        if strips is not None and strips[0] == key:
+            return strips[1]
+        num_x = len( x_edges ) - 1
+        if key != self._last_x_edges or ( self._height + 1 ) * num_x > 2**24:
+            self._last_x_edges = key
+            return None
+        inside = ( self._cols >= x_edges[0] ) & ( self._cols < x_edges[-1] )
+        block_x = self._blocks( x_edges, self._cols[inside] )
+        counts = numpy.bincount( self._rows[inside] * num_x + block_x, minlength=self._height * num_x )
+        prefix = numpy.zeros( ( self._height + 1, num_x ), dtype=numpy.int32 if len( self._cols ) < 2**31 else numpy.int64 )
+        numpy.cumsum( counts.reshape( self._height, num_x ), axis=0, out=prefix[1:] )
+        self._strips = ( key, prefix )
+        return prefix
+
+
+    def grid_counts( self, x_edges, y_edges ):
+        # nnzs of every block of the grid given by the (sorted) column and
+        # row edges, from the first to the last edge of each (the whole
+        # tensor or a region of it), in a single vectorized pass; returns
+        # a (rows, cols) array of blocks
+        x_edges = numpy.asarray( x_edges, dtype=numpy.int64 )
+        y_edges = numpy.asarray( y_edges, dtype=numpy.int64 )
+        if self._sat is None:
+            strips = self._column_strips( x_edges )
+            if strips is not None:
+                corners = strips[y_edges]
+                return ( corners[1:] - corners[:-1] ).astype( numpy.int64 )
+            # only the non-zeros inside the region
+            begin = self._indptr[y_edges[0]]
+            end = self._indptr[y_edges[-1]]
+            cols = self._cols[begin:end]
+            rows = self._rows[begin:end]
+            inside = ( cols >= x_edges[0] ) & ( cols < x_edges[-1] )
+            block_x = self._blocks( x_edges, cols[inside] )
+            block_y = self._blocks( y_edges, rows[inside] )
+            num_x = len( x_edges ) - 1
+            num_y = len( y_edges ) - 1
+            counts = numpy.bincount( block_y * num_x + block_x, minlength=num_x * num_y )
+            return counts.reshape( num_y, num_x )
+        corners = self._sat[numpy.ix_( y_edges, x_edges )].astype( numpy.int64 )
+        return corners[1:, 1:] - corners[:-1, 1:] - corners[1:, :-1] + corners[:-1, :-1]
+
+
+    def sparse_grid_counts( self, x_edges, y_edges ):
+        # same as grid_counts, as a sparse matrix, for fine grids (e.g. a
+        # block per row or column) where most blocks are empty
+        if self._sat is not None:
+            return scipy.sparse.csr_matrix( self.grid_counts( x_edges, y_edges ) )
+        x_edges = numpy.asarray( x_edges, dtype=numpy.int64 )
+        y_edges = numpy.asarray( y_edges, dtype=numpy.int64 )
+        begin = self._indptr[y_edges[0]]
+        end = self._indptr[y_edges[-1]]
+        cols = self._cols[begin:end]
+        rows = self._rows[begin:end]
+        inside = ( cols >= x_edges[0] ) & ( cols < x_edges[-1] )
+        block_x = self._blocks( x_edges, cols[inside] )
+        block_y = self._blocks( y_edges, rows[inside] )
+        counts = scipy.sparse.coo_matrix( ( numpy.ones( len( block_x ), dtype=numpy.int64 ), ( block_y, block_x ) ),
+                                          shape=( len( y_edges ) - 1, len( x_edges ) - 1 ) )
+        return counts.tocsr()
+
+
+def stream_pattern( tensor, block_bytes=2**26 ):
+    # non-zero pattern of a dense (e.g. memory-mapped) tensor as a CSR
+    # matrix, built in a single pass over blocks of rows, so that only
+    # one block of the tensor is in memory at a time
+    height, width = tensor.shape
+    block_rows = max( 1, block_bytes // max( 1, width * tensor.itemsize ) )
+    indptr = numpy.zeros( height + 1, dtype=numpy.int64 )
+    indices = []
+    index_dtype = numpy.int32 if width < 2**31 else numpy.int64
+    for row in range( 0, height, block_rows ):
+        block = numpy.asarray( tensor[row:row + block_rows] )
+        rows, cols = numpy.nonzero( block )
+        indptr[row + 1:row + 1 + len( block )] = numpy.bincount( rows, minlength=len( block ) )
+        indices.append( cols.astype( index_dtype ) )
+    numpy.cumsum( indptr, out=indptr )
+    indices = numpy.concatenate( indices ) if indices else numpy.zeros( 0, dtype=index_dtype )
+    return scipy.sparse.csr_matrix( ( numpy.ones( len( indices ), dtype=numpy.int8 ), indices, indptr ),
+                                    shape=tensor.shape )
+
+
+def cached_pattern( index_cache, name, tensor ):
+    # what to index a tensor by: a memory-mapped tensor is streamed into
+    # its non-zero pattern once, and the pattern kept in index_cache for
+    # its nnz index, those of the union, intersection or product, and its
+    # nnz total; any other tensor is indexed as it is
+    if not isinstance( tensor, numpy.memmap ):
+        return tensor
+    key = ( '__pattern__', name )
+    if key not in index_cache:
+        index_cache[key] = stream_pattern( tensor )
+    return index_cache[key]
+
+
+def _patterns( tensors ):
+    # non-zero patterns of the tensors, all sparse if any of them is (or
+    # is memory-mapped, and streamed into a sparse pattern)
+    tensors = list( tensors )
+    if any( scipy.sparse.issparse( tensor ) or isinstance( tensor, numpy.memmap ) for tensor in tensors ):
+        return [ stream_pattern( tensor ) if isinstance( tensor, numpy.memmap )
+                 else scipy.sparse.csr_matrix( tensor != 0, dtype=numpy.int8 ) for tensor in tensors ]
+    return [ tensor != 0 for tensor in tensors ]
+
+
+def pattern_union( tensors ):
+    patterns = _patterns( tensors )
+    union = patterns[0]
+    for pattern in patterns[1:]:
+        if scipy.sparse.issparse( union ):
+            union = union + pattern
+        else:
+            union = numpy.logical_or( union, pattern )
+    return union
+
+
+def pattern_intersection( tensors ):
+    patterns = _patterns( tensors )
+    intersection = patterns[0]
+    for pattern in patterns[1:]:
+        if scipy.sparse.issparse( intersection ):
+            intersection = intersection.multiply( pattern )
+        else:
+            intersection = numpy.logical_and( intersection, pattern )
+    return intersection
+
+
+def pattern_product( left, right ):
+    # non-zero pattern of the matrix product left @ right, without
+    # cancellations: an output is non-zero if any partial product is
+    left, right = _patterns( [left, right] )
+    if scipy.sparse.issparse( left ):
+        product = left.astype( numpy.int64 ) @ right.astype( numpy.int64 )
+        product.data = product.data != 0
+        product.eliminate_zeros()
+        return product
+    # float32 counts are exact enough to tell zero from non-zero
+    return ( left.astype( numpy.float32 ) @ right.astype( numpy.float32 ) ) != 0
@@ -0,0 +1,84 @@
+import contextlib
+import json
+import logging
+import time
+
+import numpy
+
+from util import peak_memory_mb
+
+logger = logging.getLogger(__name__)
+
+class Profiler:
+
+
+  def __init__( self ):
+    self._phases = {}
+    self._records = {}
+
+
+  @contextlib.contextmanager
+  def phase( self, name ):
+    # wall time of the phase, and the peak RSS of the process once the
+    # phase is over (a high-water mark, so it only grows phase by phase)
+    start = time.perf_counter()
+    try:
+      yield
+    finally:
+      self.add_phase_time(name, time.perf_counter() - start)
+      self._phases[name]["peak_memory_mb"] = peak_memory_mb()
+      logger.info("phase %s: %.3f s, peak memory %.1f MB",
+                  name, self._phases[name]["wall_time_s"], self._phases[name]["peak_memory_mb"])
+
+
+  def add_phase_time( self, name, seconds ):
+    # phases that are interleaved with others (e.g. the lazy tile slicing
+    # inside save_tiles) accumulate their time piece by piece
+    phase = self._phases.setdefault(name, {"wall_time_s": 0.0})
+    phase["wall_time_s"] += seconds
+
+
+  def record( self, key, value ):
+    self._records[key] = value
+
+
+  def record_tiles( self, results, nnz_of_tile ):
+    # number of tiles and the distribution of their sizes and nnzs
+    widths = numpy.array([next(iter(pair.values()))[2] for pair in results], dtype=numpy.int64)
+    heights = numpy.array([next(iter(pair.values()))[3] for pair in results], dtype=numpy.int64)
+    nnzs = numpy.array([nnz_of_tile(pair) for pair in results], dtype=numpy.int64)
+    self._records["tiles"] = {
+      "num_tiles": len(results),
+      "width": self._distribution(widths),
+      "height": self._distribution(heights),
+      "area": self._distribution(widths * heights),
+      "nnz": self._distribution(nnzs),
+    }
+
+
+  def _distribution( self, values ):
+    if len(values) == 0:
+      return {}
+    distribution = {
+      "min": int(values.min()),
+      "max": int(values.max()),
+      "mean": float(values.mean()),
+      "p50": float(numpy.percentile(values, 50)),
+      "p90": float(numpy.percentile(values, 90)),
+      "p99": float(numpy.percentile(values, 99)),
+    }
+    # power-of-two histogram: bucket k counts the values in [2^(k-1), 2^k)
+    buckets = numpy.zeros(len(values), dtype=numpy.int64)
+    positive = values > 0
+    buckets[positive] = numpy.floor(numpy.log2(values[positive])).astype(numpy.int64) + 1
+    counts = numpy.bincount(buckets)
+    distribution["log2_histogram"] = {int(k): int(c) for k, c in enumerate(counts) if c > 0}
+    return distribution
+
+
+  def save( self, output_path ):
+    profile = {"phases": self._phases}
+    profile.update(self._records)
+    with open(output_path, "w") as f:
+      json.dump(profile, f, indent=2)
+    logger.info("profile saved to %s", output_path)
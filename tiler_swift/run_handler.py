@@ -1,17 +1,108 @@
+import collections
+import concurrent.futures
+import contextlib
+import functools
+import itertools
+import logging
+import multiprocessing
 import os
+import threading
+import time
 import yaml
 import numpy
-import sparse
+import scipy.sparse
 import toml
 
+from nnz_index import Nnz_Index, cached_pattern
+from profiler import Profiler
+from scheduler import Tile_Scheduler
 from tiler import Tiler
-from util import coo2csf
+from tile_writer import tile_output_formats, select_tile_format, tile_arrays, write_tile_text, write_tile_npy, Packed_Tile_Writer
+from util import count_nnz, load_tensor, peak_memory_mb
+
+logger = logging.getLogger(__name__)
+
+def emit_tile( output_path, output_format, tile_name, pairs, verbose=False, tile_formats=("csf",), element_size=2 ):
+  # convert one tile pair to its storage format (the smallest of
+  # tile_formats, see tile_writer.py) and write it out, this runs in the
+  # emission worker processes; for the packed format the arrays are
+  # returned so that the parent process appends them to the single file
+  tile_path = os.path.join(output_path, tile_name)
+  if output_format != "packed" and not os.path.exists(tile_path):
+    os.makedirs(tile_path, exist_ok=True)
+  emitted = {}
+  for name, tile in pairs.items():
+    # the binary formats skip the extra copy of the whole tile
+    if output_format == "text":
+      if scipy.sparse.issparse(tile):
+        # never densify a sparse tile, it can be far larger than its nnzs
+        scipy.sparse.save_npz(os.path.join(tile_path, name), tile)
+        if verbose:
+          print(f"Tile {name} in scipy sparse format saved to {tile_path}/{name}.npz")
+      else:
+        numpy.save(os.path.join(tile_path, name), tile)
+        if verbose:
+          print(f"Tile {name} in numpy format saved to {tile_path}/{name}.npy")
+    tile_format = select_tile_format(count_nnz(tile), tile.shape[0] * tile.shape[1], element_size, tile_formats)
+    arrays = tile_arrays(name, tile_format, tile)
+    if output_format == "text":
+      write_tile_text(tile_path, name, arrays, verbose)
+      arrays = None
+    elif output_format == "npy":
+      write_tile_npy(tile_path, name, arrays, verbose)
+      arrays = None
+    emitted[name] = (tile_format, arrays)
+  return emitted
+
+
+def bounded_map( executor, emit, tile_pairs, window ):
+  # like executor.map, but keeps at most `window` tiles in flight, so a
+  # lazy stream of tiles is never materialized all at once
+  pending = collections.deque()
+  for tile_name, tile_pair in tile_pairs:
+    pending.append((tile_name, executor.submit(emit, tile_name, tile_pair)))
+    if len(pending) >= window:
+      tile_name, future = pending.popleft()
+      yield tile_name, future.result()
+  while pending:
+    tile_name, future = pending.popleft()
+    yield tile_name, future.result()
+
+
+# tensor sets of the running sweep, inherited by the forked workers
+_sweep_tensor_sets = {}
+
+def sweep_one( combination, verbose, cache=None ):
+  # run one config x benchmark combination of a sweep, with its log
+  # written to log_main.log in its output directory, like run.sh does
+  config, key, output_path = combination
+  tensors, index_cache = _sweep_tensor_sets[key]
+  os.makedirs(output_path, exist_ok=True)
+  with open(os.path.join(output_path, "log_main.log"), "w") as log_file:
+    with contextlib.redirect_stdout(log_file):
+      rhandler = RunHandler(cache)
+      rhandler._config = config
+      rhandler._tensors = tensors
+      rhandler.report_config(index_cache)
+      rhandler.run(output_path, verbose, index_cache=index_cache)
+  return output_path
+
 
 class RunHandler:
 
 
-  def __init__( self ):
-    pass
+  def __init__( self, cache=None, progress=None ):
+    self._profiler = Profiler()
+    # on-disk cache of tiling results (Tiling_Cache), None to always tile
+    self._cache = cache
+    # called with (event, details) as a run goes, e.g. by the tiling
+    # service to stream the results back before the tiles are written
+    self._progress = progress
+
+
+  def notify( self, event, **details ):
+    if self._progress is not None:
+      self._progress(event, details)
 
 
   def print_banner( self ):
@@ -35,17 +126,37 @@ class RunHandler:
       self._config = yaml.safe_load(f)
 
 
+  def check_config( self, incremental=False ):
+    # combinations the tilers do not support, rejected before any work:
+    # matmul tiles the whole tensors in one level only
+    if self._config.get('operation') == 'matmul':
+      if self._config.get('hierarchical_tiling', False):
+        print("Hierarchical tiling does not support the matmul operation.")
+        exit(1)
+      if incremental:
+        print("Incremental tiling does not support the matmul operation.")
+        exit(1)
+
+
   def load_tensors( self, tensor_path ):
     self._tensors = {}
     for name in self._config['input_matrix_names']:
-      tensor_file = os.path.join(tensor_path, f"{name}.npy")
-      if not os.path.exists(tensor_file):
-        print(f"Tensor file {tensor_file} does not exist.")
+      # dense .npy, sparse .npz or .mtx, sparse inputs stay sparse; out
+      # of core, dense inputs stay on disk and the tiles are read from
+      # there, only the rows and columns of a tile at a time
+      tensor = load_tensor(tensor_path, name, mmap=self._config.get('out_of_core', False))
+      if tensor is None:
+        print(f"Tensor file {tensor_path}/{name}.(npy|npz|mtx) does not exist.")
         exit(1)
-      self._tensors[name] = numpy.load(tensor_file)
+      self._tensors[name] = tensor
 
 
-  def report_config( self ):
+  def report_config( self, index_cache=None ):
+    # with the index cache the model will use, memory-mapped tensors are
+    # counted on the patterns their nnz indexes are built from, instead
+    # of being read once more (see cached_pattern)
+    if index_cache is None:
+      index_cache = {}
     print("")
     print("Configurations:")
     print("--------------------------------------------------------------")
@@ -56,8 +167,8 @@ class RunHandler:
     print("--------------------------------------------------------------")
     for name, tensor in self._tensors.items():
       shape = tensor.shape
-      nnz = numpy.count_nonzero(tensor)
-      total_elements = tensor.size
+      nnz = count_nnz(cached_pattern(index_cache, name, tensor))
+      total_elements = shape[0] * shape[1]
       sparsity = 100.0 * ( (total_elements - nnz) / total_elements)
       print(f"{name:<10}: shape: {shape}, nnz: {nnz}, sparsity: {sparsity:.2f}%")
     print("")
@@ -108,88 +219,527 @@ class RunHandler:
     print(f"Results saved to {output_path}/{result_file_name}")
 
 
-  def gen_tiles ( self, results ):
-    self._tile_pairs = []
-    for idx, pairs in enumerate(results):
-      self._tile_pairs.append({})
+  def save_summary( self, results, estimated_runtime, output_path, estimated_transfer_cost=None ):
+    summary_file_name = "summary.yaml"
+    summary = {
+      "num_tiles": len(results),
+      "estimated_runtime": estimated_runtime,
+    }
+    print(f"Number of tiles: {len(results)}, estimated runtime: {estimated_runtime}")
+    if estimated_transfer_cost is not None:
+      # two-level tiling only
+      summary["estimated_transfer_cost"] = estimated_transfer_cost
+      print(f"Estimated off-chip transfer cost: {estimated_transfer_cost}")
+    with open(os.path.join(output_path, summary_file_name), "w") as f:
+      yaml.dump(summary, f)
+    print(f"Summary saved to {output_path}/{summary_file_name}")
+    return summary
+
+
+  def save_hierarchy( self, glb_tiles, output_path ):
+    # nesting of a two-level tiling, one entry per GLB super-tile in load
+    # order with its rectangle, its memory tiles and its transfer cost:
+    # - glb_tile: glb_tile_0
+    #   rect: {'A': [x, y, w, h], 'B': [x, y, w, h]}
+    #   tiles: [tile_0, tile_1, ...]
+    #   transfer_cost: ...
+    hierarchy_file_name = "hierarchy.yaml"
+    hierarchy = []
+    for idx, glb_tile in enumerate(glb_tiles):
+      hierarchy.append({
+        "glb_tile": "glb_tile_" + str(idx),
+        "rect": glb_tile["rect"],
+        "tiles": ["tile_" + str(tile_idx) for tile_idx in glb_tile["tiles"]],
+        "transfer_cost": int(glb_tile["transfer_cost"]),
+      })
+    print(f"Number of GLB super-tiles: {len(glb_tiles)}")
+    with open(os.path.join(output_path, hierarchy_file_name), "w") as f:
+      yaml.dump(hierarchy, f, sort_keys=False)
+    print(f"Hierarchy saved to {output_path}/{hierarchy_file_name}")
+
+
+  def save_schedule( self, schedule, output_path ):
+    # tiles of every parallel unit in run order, with the estimated
+    # runtime of every unit and the makespan, the longest of them:
+    # num_units: 2
+    # makespan: ...
+    # units:
+    # - unit: 0
+    #   runtime: ...
+    #   tiles: [tile_0, tile_3, ...]
+    schedule_file_name = "schedule.yaml"
+    document = {
+      "num_units": schedule["num_units"],
+      "makespan": int(schedule["makespan"]),
+      "units": [{
+        "unit": idx,
+        "runtime": int(unit["runtime"]),
+        "tiles": ["tile_" + str(tile_idx) for tile_idx in unit["tiles"]],
+      } for idx, unit in enumerate(schedule["units"])],
+    }
+    print(f"Tiles scheduled on {schedule['num_units']} units, estimated makespan: {schedule['makespan']}")
+    with open(os.path.join(output_path, schedule_file_name), "w") as f:
+      yaml.dump(document, f, sort_keys=False)
+    print(f"Schedule saved to {output_path}/{schedule_file_name}")
+
+
+  def load_hierarchy( self, output_path ):
+    # GLB super-tiles of a saved two-level tiling (see save_hierarchy),
+    # with tile indices, or None if the tiling has a single level
+    hierarchy_path = os.path.join(output_path, "hierarchy.yaml")
+    if not os.path.exists(hierarchy_path):
+      return None
+    with open(hierarchy_path, 'r') as f:
+      hierarchy = yaml.safe_load(f)
+    return [{
+      "rect": glb_tile["rect"],
+      "tiles": [int(tile_name[len("tile_"):]) for tile_name in glb_tile["tiles"]],
+      "transfer_cost": glb_tile["transfer_cost"],
+    } for glb_tile in hierarchy]
+
+
+  def load_tile_formats( self, output_path ):
+    # storage formats of the tiles already on disk, from the manifest
+    try:
+      with open(os.path.join(output_path, "tile_pair_paths.toml"), "r") as toml_file:
+        return toml.load(toml_file)["sam_config"].get("tile_formats", {})
+    except (OSError, KeyError, toml.TomlDecodeError):
+      return {}
+
+
+  def gen_tiles ( self, results, indices=None ):
+    # lazily slice one tile pair at a time, so that only the tiles in
+    # flight are held in memory instead of a copy of every tensor;
+    # indices restricts it to some of the tiles
+    if indices is None:
+      indices = range(len(results))
+    for idx in indices:
+      pairs = results[idx]
+      start = time.perf_counter()
+      tile_pair = {}
       for name, tile_loc_size in pairs.items():
         x = tile_loc_size[0]
         y = tile_loc_size[1]
         w = tile_loc_size[2]
         h = tile_loc_size[3]
-        tile = self._tensors[name][x:x+w, y:y+h]
-        self._tile_pairs[idx][name] = tile
+        tile = self._tensors[name][y:y+h, x:x+w]
+        tile_pair[name] = tile
+      # slicing is interleaved with save_tiles, so time it piece by piece
+      self._profiler.add_phase_time("gen_tiles", time.perf_counter() - start)
+      yield "tile_" + str(idx), tile_pair
 
-  def save_tiles( self, output_path, verbose ):
+  def save_tiles( self, results, output_path, verbose, jobs=1, indices=None ):
+    # text (default, read by comal), npy or packed, see tile_writer.py;
+    # with indices only those tiles are (re)written, the others are
+    # left as they are on disk, and the manifest lists them all
+    output_format = self._config.get('tile_output_format', 'text')
+    if output_format not in tile_output_formats:
+      print(f"Unknown tile output format: {output_format}")
+      exit(1)
+    if not os.path.exists(output_path):
+      os.makedirs(output_path, exist_ok=True)
+    tile_formats = tuple(self._config.get('tile_formats', ['csf']))
+    emit = functools.partial(emit_tile, output_path, output_format, verbose=verbose,
+                             tile_formats=tile_formats, element_size=self._config['element_size'])
+    if output_format == "packed":
+      packed_writer = Packed_Tile_Writer(output_path, append=indices is not None)
     tile_pair_path_list = {}
     tile_pair_path_list["sam_config"] = {}
-    tile_pair_path_list["sam_config"]["sam_path"] = []
-    for idx, pairs in enumerate(self._tile_pairs):
-      tile_path = os.path.join(output_path, "tile_" + str(idx))
-      tile_pair_path_list["sam_config"]["sam_path"].append("tile_" + str(idx))
-      if not os.path.exists(tile_path):
-        os.makedirs(tile_path, exist_ok=True)
-      for name, tile in pairs.items():
-        numpy.save(os.path.join(tile_path, name), tile)
-        if verbose:
-          print(f"Tile {name} in numpy format saved to {tile_path}/{name}.npy")
-        tile_coo_sparse = sparse.COO(tile)
-        pos_dict, crd_dict, data = coo2csf(tile_coo_sparse)
-        for dim, seg_array in pos_dict.items():
-          with open(os.path.join(tile_path, "tensor_" + name + "_mode_" + str(dim) + "_seg"), "w") as seg_file:
-            for seg in seg_array:
-              seg_file.write(str(seg))
-              seg_file.write("\n")
-            if verbose:
-              print(f"Segment data for mode {str(dim)} of tile {name} saved to {seg_file.name}")
-        for dim, crd_array in crd_dict.items():
-          with open(os.path.join(tile_path, "tensor_" + name + "_mode_" + str(dim) + "_crd"), "w") as crd_file:
-            for crd in crd_array:
-              crd_file.write(str(crd))
-              crd_file.write("\n")
-            if verbose:
-              print(f"Coordinate data for mode {str(dim)} of tile {name} saved to {seg_file.name}")
-        with open(os.path.join(tile_path, "tensor_" + name + "_mode_vals"), "w") as val_file:
-          for val in data:
-            val_file.write(str(val))
-            val_file.write("\n")
-          if verbose:
-            print(f"Value data of tile {name} saved to {val_file.name}")
-      with open(os.path.join(output_path, "tile_pair_paths.toml"), "w") as toml_file:
-        toml.dump(tile_pair_path_list, toml_file)
+    tile_pair_path_list["sam_config"]["sam_path"] = ["tile_" + str(idx) for idx in range(len(results))]
+    # storage format of every tensor tile, when any but csf is allowed;
+    # tiles that are not rewritten keep the format they have on disk
+    stored_formats = {}
+    if indices is not None and tile_formats != ("csf",):
+      stored_formats = self.load_tile_formats(output_path)
+    # the tiles are independent, so the conversion and the writes can be
+    # spread over a process pool; results come back in tile order
+    if jobs > 1:
+      # forking from a thread (e.g. a request of the tiling service) may
+      # copy a lock held by another thread and deadlock the workers, so
+      # there they start from a fresh interpreter instead
+      context = None
+      if threading.current_thread() is not threading.main_thread():
+        start_method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+        context = multiprocessing.get_context(start_method)
+      executor = concurrent.futures.ProcessPoolExecutor(max_workers=jobs, mp_context=context)
+      emitted = bounded_map(executor, emit, self.gen_tiles(results, indices), 2 * jobs)
+    else:
+      executor = None
+      emitted = ((tile_name, emit(tile_name, tile_pair)) for tile_name, tile_pair in self.gen_tiles(results, indices))
+    try:
+      for tile_name, tile_emitted in emitted:
+        stored_formats[tile_name] = {}
+        for name, (tile_format, arrays) in tile_emitted.items():
+          stored_formats[tile_name][name] = tile_format
+          if output_format == "packed":
+            # a single file, so the packing itself stays in this process
+            packed_writer.write(tile_name, name, arrays, verbose)
+    finally:
+      # also when a tile fails: the tiling service keeps running after a
+      # failed request, and must not leak the workers
+      if executor is not None:
+        executor.shutdown(cancel_futures=True)
+    if output_format == "packed":
+      packed_writer.close()
+    if tile_formats != ("csf",):
+      tile_pair_path_list["sam_config"]["tile_formats"] = {
+        "tile_" + str(idx): stored_formats["tile_" + str(idx)] for idx in range(len(results))
+        if "tile_" + str(idx) in stored_formats
+      }
+    with open(os.path.join(output_path, "tile_pair_paths.toml"), "w") as toml_file:
+      toml.dump(tile_pair_path_list, toml_file)
     print(f"Tiles and list of tiles saved to {output_path}")
+    if executor is None:
+      logger.info("peak memory: %.1f MB", peak_memory_mb())
+    else:
+      logger.info("peak memory: %.1f MB, emission workers: %.1f MB", peak_memory_mb(), peak_memory_mb(children=True))
+      self._profiler.record("emission_workers_peak_memory_mb", peak_memory_mb(children=True))
 
 
-  def launch( self, config_path, tensor_path, output_path, verbose ):
+  def launch( self, config_path, tensor_path, output_path, verbose, jobs=1 ):
 
     # welcome!
     self.print_banner()
 
-    # loading configurations
-    self.load_config(config_path)
-    
-    # loading input tensors
-    self.load_tensors(tensor_path)
-    
+    with self._profiler.phase("load"):
+      # loading configurations
+      self.load_config(config_path)
+
+      # loading input tensors
+      self.load_tensors(tensor_path)
+
     # report configurations
-    self.report_config()
+    index_cache = {}
+    self.report_config(index_cache)
+
+    # tile, check and save everything
+    self.run(output_path, verbose, jobs, index_cache)
+
+    return
+
+
+  def run( self, output_path, verbose, jobs=1, index_cache=None ):
+    self.check_config()
+    profiler = self._profiler
+    tile_path = output_path + "/tiles"
+    output_format = self._config.get('tile_output_format', 'text')
+
+    # same tensors and tiling config as an earlier run, reuse its results
+    cached = None
+    if self._cache is not None:
+      with profiler.phase("cache_lookup"):
+        cache_key = self._cache.key(self._config, self._tensors)
+        cached = self._cache.load(cache_key)
+      profiler.record("tiling_cache", "hit" if cached is not None else "miss")
+
+    if cached is not None:
+      results = cached["results"]
+      summary = cached["summary"]
+      print(f"Tiling results found in the cache ({cache_key[:16]})")
+      self.save_results(results, output_path)
+      self.save_summary(results, summary["estimated_runtime"], output_path, summary.get("estimated_transfer_cost"))
+      if "hierarchy" in cached:
+        self.save_hierarchy(cached["hierarchy"], output_path)
+      if "schedule" in cached:
+        self.save_schedule(cached["schedule"], output_path)
+      self.notify("results", results_path=os.path.join(output_path, "results.yaml"), summary=summary)
+      with profiler.phase("save_tiles"):
+        if self._cache.load_tiles(cache_key, output_format, tile_path):
+          print(f"Tiles copied from the cache to {tile_path}")
+        else:
+          self.save_tiles(results, tile_path, verbose, jobs)
+          if self._cache._with_tiles:
+            # cached without tiles (or in another format) so far
+            self._cache.store(cache_key, cached, output_format, tile_path)
+      self.notify("tiles", tile_path=tile_path, manifest=os.path.join(tile_path, "tile_pair_paths.toml"))
+      # on the nnz indexes the model builds (and shares through the index
+      # cache), rather than slices that read a memory-mapped tensor in full
+      if index_cache is None:
+        index_cache = {}
+      for name, tensor in self._tensors.items():
+        if name not in index_cache:
+          index_cache[name] = Nnz_Index(cached_pattern(index_cache, name, tensor))
+      profiler.record_tiles(results, lambda pair: sum(index_cache[name].count(rect) for name, rect in pair.items()))
+      profiler.save(os.path.join(output_path, "profile.json"))
+      return
 
     # Execute the tiler
-    tiler = Tiler(config=self._config, tensors=self._tensors)
-    results = tiler.tile()
+    tiler = Tiler(config=self._config, tensors=self._tensors, index_cache=index_cache)
+    with profiler.phase("model"):
+      model = tiler.build_model()
+    with profiler.phase("tile"):
+      results = tiler.tile()
+    profiler.record("model_calls", tiler.model_stats())
 
     # sanity check
-    self.results_sanity_check(results)
+    with profiler.phase("sanity_check"):
+      self.results_sanity_check(results)
+
+    # save the tiling decision results
+    documents = {"results": results}
+    self.save_results(results, output_path)
+    documents["summary"] = self.save_summary(results, tiler.estimate_runtime(results), output_path,
+                                             tiler.estimate_transfer_cost())
+    if tiler.glb_tiles is not None:
+      # two-level tiling, the GLB super-tiles the memory tiles nest in
+      documents["hierarchy"] = tiler.glb_tiles
+      self.save_hierarchy(tiler.glb_tiles, output_path)
+    if self._config.get('num_units', 1) > 1:
+      # spread the tiles over the parallel units
+      with profiler.phase("schedule"):
+        documents["schedule"] = Tile_Scheduler(self._config, tiler).schedule(results)
+      self.save_schedule(documents["schedule"], output_path)
+    self.notify("results", results_path=os.path.join(output_path, "results.yaml"), summary=documents["summary"])
+
+    # generate and save the tiles, one tile at a time
+    with profiler.phase("save_tiles"):
+      self.save_tiles(results, tile_path, verbose, jobs)
+    self.notify("tiles", tile_path=tile_path, manifest=os.path.join(tile_path, "tile_pair_paths.toml"))
+
+    if self._cache is not None:
+      with profiler.phase("cache_store"):
+        self._cache.store(cache_key, documents, output_format, tile_path)
+
+    # timing, memory, model calls and tile statistics
+    profiler.record_tiles(results, lambda pair: sum(model.count_nnz(name, rect) for name, rect in pair.items()))
+    profiler.save(os.path.join(output_path, "profile.json"))
+
+
+  def load_diff( self, diff_path ):
+    # the coordinates changed since the previous run, per tensor:
+    #   A:
+    #     - [row, col]
+    #     ...
+    if not os.path.exists(diff_path):
+      print(f"Diff file {diff_path} does not exist.")
+      exit(1)
+    with open(diff_path, 'r') as f:
+      diff = yaml.safe_load(f) or {}
+    changed = {}
+    for name, coords in diff.items():
+      if name not in self._tensors:
+        print(f"Tensor {name} of the diff is not an input tensor.")
+        exit(1)
+      coords = numpy.asarray(coords if coords else [], dtype=numpy.int64).reshape(-1, 2)
+      shape = self._tensors[name].shape
+      if numpy.any(coords < 0) or numpy.any(coords >= shape):
+        print(f"Diff of tensor {name} has coordinates outside of its shape {shape}.")
+        exit(1)
+      changed[name] = coords
+    return changed
+
+
+  def affected_tiles( self, results, changed ):
+    # indices of the tiles that hold any changed coordinate of their tensor
+    affected = numpy.zeros(len(results), dtype=bool)
+    for name, coords in changed.items():
+      rects = numpy.array([pair[name] for pair in results], dtype=numpy.int64).reshape(-1, 4)
+      # coordinates x tiles at a time, in chunks of bounded size
+      chunk = max(1, 2**24 // max(1, len(results)))
+      for start in range(0, len(coords), chunk):
+        rows = coords[start:start+chunk, 0:1]
+        cols = coords[start:start+chunk, 1:2]
+        inside = (cols >= rects[:, 0]) & (cols < rects[:, 0] + rects[:, 2]) & \
+                 (rows >= rects[:, 1]) & (rows < rects[:, 1] + rects[:, 3])
+        affected |= inside.any(axis=0)
+    return numpy.flatnonzero(affected).tolist()
+
+
+  def split_glb_tile( self, glb_model, rect, tiles, results ):
+    # parts [(rect, tiles, transfer_cost)] of a GLB super-tile that each
+    # fit in the GLB: while a part does not, cut it in two along the edges
+    # of its memory tiles (the cut no tile crosses closest to its middle),
+    # so that the memory tiles and their indices stay as they are; None
+    # if a part does not fit and no tile edge cuts it
+    transfer_cost = glb_model.estimate_tile_runtime(rect)
+    if transfer_cost >= 0:
+      return [(rect, tiles, transfer_cost)]
+    tile_rects = numpy.array([next(iter(results[idx].values())) for idx in tiles], dtype=numpy.int64).reshape(-1, 4)
+    best = None
+    for axis in (0, 1):
+      starts = tile_rects[:, axis]
+      ends = starts + tile_rects[:, axis + 2]
+      cuts = numpy.unique(starts)
+      cuts = cuts[cuts > rect[axis]]
+      # tiles that start before a cut, less those that end before it
+      crossed = numpy.searchsorted(numpy.sort(starts), cuts) - numpy.searchsorted(numpy.sort(ends), cuts, side='right')
+      cuts = cuts[crossed == 0]
+      if len(cuts) == 0:
+        continue
+      cut = int(cuts[numpy.argmin(numpy.abs(2 * (cuts - rect[axis]) - rect[axis + 2]))])
+      balance = abs(2 * (cut - rect[axis]) - rect[axis + 2]) / rect[axis + 2]
+      if best is None or balance < best[0]:
+        best = (balance, axis, cut)
+    if best is None:
+      return None
+    _, axis, cut = best
+    first = list(rect)
+    first[axis + 2] = cut - rect[axis]
+    second = list(rect)
+    second[axis] = cut
+    second[axis + 2] = rect[axis] + rect[axis + 2] - cut
+    before = tile_rects[:, axis] < cut
+    parts = []
+    for part_rect, inside in ((first, before), (second, ~before)):
+      part = self.split_glb_tile(glb_model, part_rect, [idx for idx, keep in zip(tiles, inside) if keep], results)
+      if part is None:
+        return None
+      parts += part
+    return parts
+
+
+  def launch_incremental( self, config_path, tensor_path, output_path, diff_path, verbose, jobs=1 ):
+    # update the tiling in output_path of a previous run after a localized
+    # change of the tensors: only the tiles touched by the diff are
+    # re-tiled and rewritten, each keeps its index (for the first tile of
+    # its re-tiling) and the extra tiles are appended at the end
 
-    # generate tiles
-    self.gen_tiles(results)
+    # welcome!
+    self.print_banner()
+
+    profiler = self._profiler
+    with profiler.phase("load"):
+      self.load_config(config_path)
+      self.check_config(incremental=True)
+      self.load_tensors(tensor_path)
+      results_path = os.path.join(output_path, "results.yaml")
+      if not os.path.exists(results_path):
+        print(f"Previous results {results_path} do not exist.")
+        exit(1)
+      with open(results_path, 'r') as f:
+        results = yaml.load(f, Loader=getattr(yaml, "CSafeLoader", yaml.SafeLoader))
+      changed = self.load_diff(diff_path)
+      glb_tiles = self.load_hierarchy(output_path)
+
+    # report configurations
+    index_cache = {}
+    self.report_config(index_cache)
+
+    tiler = Tiler(config=self._config, tensors=self._tensors, index_cache=index_cache)
+    with profiler.phase("model"):
+      model = tiler.build_model()
+    with profiler.phase("tile"):
+      affected = self.affected_tiles(results, changed)
+      rewritten = []
+      new_tiles = {}
+      for idx in affected:
+        # the tile may no longer fit (or the other way round), so tile
+        # its region again with the new tensors
+        region = tiler.tile(next(iter(results[idx].values())))
+        results[idx] = region[0]
+        new_tiles[idx] = list(range(len(results), len(results) + len(region) - 1))
+        results += region[1:]
+        rewritten += [idx] + new_tiles[idx]
+      if glb_tiles is not None:
+        # the new tiles nest in the super-tile of the tile they replace,
+        # whose transfer cost changes with its contents
+        glb_model = tiler.build_glb_model()
+        updated_glb_tiles = []
+        for glb_tile in glb_tiles:
+          touched = [idx for idx in glb_tile["tiles"] if idx in new_tiles]
+          for idx in touched:
+            glb_tile["tiles"] += new_tiles[idx]
+          if not touched:
+            updated_glb_tiles.append(glb_tile)
+            continue
+          # and it may no longer fit in the GLB, then it is split
+          rect = [int(value) for value in next(iter(glb_tile["rect"].values()))]
+          parts = self.split_glb_tile(glb_model, rect, glb_tile["tiles"], results)
+          if parts is None:
+            print(f"GLB super-tile {rect} no longer fits in the GLB, and cannot be split along its memory tiles.")
+            exit(1)
+          for part_rect, tiles, transfer_cost in parts:
+            updated_glb_tiles.append({
+              "rect": {name: list(part_rect) for name in glb_tile["rect"]},
+              "tiles": tiles,
+              "transfer_cost": transfer_cost,
+            })
+        if len(updated_glb_tiles) > len(glb_tiles):
+          print(f"{len(updated_glb_tiles) - len(glb_tiles)} GLB super-tiles added to fit the GLB")
+        glb_tiles = updated_glb_tiles
+    print(f"{len(affected)} tiles touched by the diff, re-tiled into {len(rewritten)} tiles")
+    profiler.record("incremental", {"affected_tiles": len(affected), "rewritten_tiles": len(rewritten)})
+    profiler.record("model_calls", tiler.model_stats())
+
+    # sanity check
+    with profiler.phase("sanity_check"):
+      self.results_sanity_check(results)
 
     # save the tiling decision results
     self.save_results(results, output_path)
+    if glb_tiles is None:
+      self.save_summary(results, tiler.estimate_runtime(results), output_path)
+    else:
+      self.save_summary(results, tiler.estimate_runtime(results), output_path,
+                        sum(glb_tile["transfer_cost"] for glb_tile in glb_tiles))
+      self.save_hierarchy(glb_tiles, output_path)
+    if self._config.get('num_units', 1) > 1:
+      # the runtimes of the re-tiled tiles changed, schedule them all again
+      with profiler.phase("schedule"):
+        self.save_schedule(Tile_Scheduler(self._config, tiler).schedule(results), output_path)
 
-    # save the generated tiles
+    # rewrite only the re-tiled tiles, and the manifest
     tile_path = output_path + "/tiles"
-    self.save_tiles(tile_path, verbose )
+    with profiler.phase("save_tiles"):
+      self.save_tiles(results, tile_path, verbose, jobs, rewritten)
 
-    return
+    # timing, memory, model calls and tile statistics
+    profiler.record_tiles(results, lambda pair: sum(model.count_nnz(name, rect) for name, rect in pair.items()))
+    profiler.save(os.path.join(output_path, "profile.json"))
 
+
+  def sweep( self, config_paths, tensor_paths, output_root, verbose, jobs=1 ):
+    # run every config x benchmark combination in one process (or one
+    # pool), loading each tensor set and building its nnz indexes once
+
+    # welcome!
+    self.print_banner()
+
+    configs = []
+    for config_path in config_paths:
+      self.load_config(config_path)
+      # up front, an exit in a pool worker would break the pool
+      self.check_config()
+      configs.append(self._config)
+
+    # one tensor set per benchmark, list of input names and out_of_core
+    # (memory-mapped or not), with the index cache shared by the models
+    # of all configs that use it
+    tensor_sets = {}
+    combinations = []
+    for tensor_path in tensor_paths:
+      for config_path, config in zip(config_paths, configs):
+        key = (tensor_path, tuple(config['input_matrix_names']), bool(config.get('out_of_core', False)))
+        if key not in tensor_sets:
+          self._config = config
+          with self._profiler.phase("load"):
+            self.load_tensors(tensor_path)
+          tensor_sets[key] = (self._tensors, {})
+        # same output layout as run.sh: cfg_<config>_bmark_<benchmark>
+        config_name = os.path.splitext(os.path.basename(config_path))[0]
+        if config_name.startswith("config_"):
+          config_name = config_name[len("config_"):]
+        benchmark_name = os.path.basename(os.path.normpath(tensor_path))
+        output_path = os.path.join(output_root, f"cfg_{config_name}_bmark_{benchmark_name}")
+        combinations.append((config, key, output_path))
+
+    # build the indexes up front, so pool workers inherit them instead
+    # of each rebuilding their own copy
+    for config, key, _ in combinations:
+      tensors, index_cache = tensor_sets[key]
+      Tiler(config=config, tensors=tensors, index_cache=index_cache).build_model()
+
+    global _sweep_tensor_sets
+    _sweep_tensor_sets = tensor_sets
+    if jobs > 1 and "fork" in multiprocessing.get_all_start_methods():
+      context = multiprocessing.get_context("fork")
+      with concurrent.futures.ProcessPoolExecutor(max_workers=jobs, mp_context=context) as executor:
+        for output_path in executor.map(sweep_one, combinations, itertools.repeat(verbose),
+                                        itertools.repeat(self._cache)):
+          print(f"[sweep] done: {output_path}")
+    else:
+      for combination in combinations:
+        print(f"[sweep] done: {sweep_one(combination, verbose, self._cache)}")
+    _sweep_tensor_sets = {}
+
+    return
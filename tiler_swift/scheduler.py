@@ -0,0 +1,88 @@
+import heapq
+import numpy
+
+class Tile_Scheduler:
+
+    def __init__( self, config, tiler ):
+        self._config = config
+        self._tiler = tiler
+        # number of CGRA arrays (memory tiles) running tiles in parallel
+        self._num_units = config.get( 'num_units', 1 )
+        assert self._num_units >= 1, "num_units must be at least 1"
+        # keep the tiles of a unit in the order the tiler emitted them,
+        # which follows the tensors (depth first for the trees, the loop
+        # nest for matmul), instead of the longest first
+        self._locality = config.get( 'schedule_locality', True )
+
+
+    def _lpt( self, runtimes ):
+        # longest processing time first: every tile, from the longest,
+        # goes to the unit with the least work so far
+        queues = [ [] for _ in range( self._num_units ) ]
+        loads = numpy.zeros( self._num_units, dtype=numpy.int64 )
+        heap = [ ( 0, unit ) for unit in range( self._num_units ) ]
+        for idx in numpy.argsort( -runtimes, kind='stable' ):
+            load, unit = heapq.heappop( heap )
+            queues[unit].append( int( idx ) )
+            loads[unit] = load + runtimes[idx]
+            heapq.heappush( heap, ( int( loads[unit] ), unit ) )
+        return queues, loads
+
+
+    def _rebalance( self, queues, loads, runtimes ):
+        # LPT is within 4/3 of the best makespan, refine it by moving one
+        # tile, or swapping two, between the most and the least loaded
+        # units while that lowers the larger of their two loads
+        for _ in range( len( runtimes ) ):
+            hi = int( numpy.argmax( loads ) )
+            lo = int( numpy.argmin( loads ) )
+            gap = loads[hi] - loads[lo]
+            if gap <= 1:
+                break
+            # runtime moved from hi to lo is r_a - r_b (r_b = 0 for a
+            # move), the closer to half the gap, the better
+            hi_runtimes = runtimes[queues[hi]]
+            lo_order = numpy.argsort( runtimes[queues[lo]], kind='stable' )
+            lo_runtimes = numpy.concatenate( ( [0], runtimes[queues[lo]][lo_order] ) )
+            target = hi_runtimes - gap / 2.0
+            pos = numpy.searchsorted( lo_runtimes, target )
+            best = None
+            for candidate in ( numpy.minimum( pos, len( lo_runtimes ) - 1 ), numpy.maximum( pos - 1, 0 ) ):
+                deltas = hi_runtimes - lo_runtimes[candidate]
+                error = numpy.where( ( deltas > 0 ) & ( deltas < gap ), numpy.abs( deltas - gap / 2.0 ), numpy.inf )
+                a = int( numpy.argmin( error ) )
+                if error[a] < numpy.inf and ( best is None or error[a] < best[0] ):
+                    best = ( error[a], a, int( candidate[a] ), int( deltas[a] ) )
+            if best is None:
+                break
+            _, a, b, delta = best
+            tile = queues[hi].pop( a )
+            if b > 0:
+                queues[hi].append( queues[lo].pop( int( lo_order[b - 1] ) ) )
+            queues[lo].append( tile )
+            loads[hi] -= delta
+            loads[lo] += delta
+        return queues
+
+
+    def schedule( self, results ):
+        # assign the tiles to the units to minimize the makespan, from the
+        # runtime of every tile on its own; returns the queue of tile
+        # indices of every unit, its estimated runtime and the makespan
+        runtimes = numpy.asarray( self._tiler.estimate_tile_runtimes( results ), dtype=numpy.int64 )
+        assert numpy.all( runtimes >= 0 ), "every tile must fit to be scheduled"
+        queues, loads = self._lpt( runtimes )
+        queues = self._rebalance( queues, loads, runtimes )
+        units = []
+        for queue in queues:
+            if self._locality:
+                queue = sorted( queue )
+            else:
+                queue = sorted( queue, key=lambda idx: -runtimes[idx] )
+            # a unit runs its queue in sequence, which for matmul also
+            # reuses the blocks shared by consecutive tiles
+            units.append( { 'tiles': queue,
+                            'runtime': int( self._tiler.estimate_runtime( [ results[idx] for idx in queue ] ) ) } )
+        return { 'num_units': self._num_units,
+                 'makespan': max( unit['runtime'] for unit in units ),
+                 'units': units }
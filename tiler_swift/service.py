@@ -0,0 +1,292 @@
+import collections
+import contextlib
+import http.server
+import json
+import logging
+import os
+import socketserver
+import sys
+import threading
+import time
+
+from run_handler import RunHandler
+from util import tensor_file
+
+logger = logging.getLogger(__name__)
+
+# Long-running tiling service: keeps the tensors (and the nnz indexes of
+# their models) of the last few tensor sets in memory, and tiles on
+# request over HTTP, on a TCP port or a Unix socket, e.g.
+#
+#   curl --unix-socket /tmp/tiler.sock http://localhost/tile -d '{
+#     "config_path": "./configs/config_cgra.yaml",
+#     "config": {"tiling_algorithm": "qtree"},
+#     "tensor_path": "./benchmarks/80x80_density0.1",
+#     "output_path": "./output"}'
+#
+# POST /tile streams back one json object per line as the run goes:
+#   {"event": "accepted", ...}
+#   {"event": "results", "results_path": ..., "summary": {...}}
+#   {"event": "tiles", "tile_path": ..., "manifest": ...}
+#   {"event": "done", "elapsed_s": ...} or {"event": "error", "message": ...}
+# GET /status returns the resident tensor sets and the request counters.
+# POST /evict drops the resident tensor sets of a directory, e.g.
+#   {"tensor_path": "./benchmarks/80x80_density0.1"}, or all of them.
+# A tensor set whose files changed on disk is loaded again on its next
+# request, evicting it only frees its memory early.
+# Requests run concurrently, one thread each; the log of a run goes to
+# log_main.log in its output directory, like run.sh does.
+
+
+class _Thread_Stdout:
+
+  # sys.stdout replacement that sends the prints of every thread to its
+  # own file, contextlib.redirect_stdout is process-wide
+  def __init__( self, default ):
+    self._default = default
+    self._local = threading.local()
+
+  def _target( self ):
+    return getattr(self._local, "target", None) or self._default
+
+  def write( self, text ):
+    return self._target().write(text)
+
+  def flush( self ):
+    self._target().flush()
+
+  @contextlib.contextmanager
+  def redirect( self, target ):
+    self._local.target = target
+    try:
+      yield
+    finally:
+      self._local.target = None
+
+
+class Tiling_Service:
+
+
+  def __init__( self, cache=None, max_tensor_sets=4, default_config_path="./configs/config_cgra.yaml" ):
+    # on-disk results cache shared by all requests (Tiling_Cache)
+    self._cache = cache
+    self._default_config_path = default_config_path
+    # (tensors, nnz index cache, file stamps) per tensor set, least
+    # recently used first
+    self._max_tensor_sets = max_tensor_sets
+    self._tensor_sets = collections.OrderedDict()
+    self._loading = {}
+    self._lock = threading.Lock()
+    self._stats = {"requests": 0, "failed": 0, "tensor_set_hits": 0, "tensor_set_misses": 0, "evictions": 0}
+
+
+  def _file_stamps( self, tensor_path, names ):
+    # (file, mtime, size) of every input, to tell a resident tensor set
+    # from the files it was loaded from once they are rewritten
+    stamps = []
+    for name in names:
+      file_path = tensor_file(tensor_path, name)
+      if file_path is None:
+        stamps.append(None)
+        continue
+      stat = os.stat(file_path)
+      stamps.append((file_path, stat.st_mtime_ns, stat.st_size))
+    return tuple(stamps)
+
+
+  def _resident( self, key, stamps ):
+    # the resident tensor set of the key, if its files did not change
+    # since it was loaded (the caller holds the lock)
+    if key not in self._tensor_sets:
+      return None
+    if self._tensor_sets[key][2] != stamps:
+      del self._tensor_sets[key]
+      logger.info("tensor set %s changed on disk, loading it again", key[0])
+      return None
+    self._tensor_sets.move_to_end(key)
+    self._stats["tensor_set_hits"] += 1
+    return self._tensor_sets[key]
+
+
+  def tensor_set( self, config, tensor_path ):
+    # a tensor set is identified by its directory, the input names and
+    # whether it is memory-mapped; it is loaded once, even by concurrent
+    # requests, again when its files change, and evicted when it is the
+    # least recently used one
+    key = (os.path.abspath(tensor_path), tuple(config["input_matrix_names"]), bool(config.get("out_of_core", False)))
+    stamps = self._file_stamps(tensor_path, key[1])
+    with self._lock:
+      tensor_set = self._resident(key, stamps)
+      if tensor_set is not None:
+        return tensor_set[:2]
+      load_lock = self._loading.setdefault(key, threading.Lock())
+    with load_lock:
+      with self._lock:
+        tensor_set = self._resident(key, stamps)
+        if tensor_set is not None:
+          return tensor_set[:2]
+      handler = RunHandler()
+      handler._config = config
+      handler.load_tensors(tensor_path)
+      # the index cache fills up with the nnz indexes of the first run
+      tensor_set = (handler._tensors, {}, stamps)
+      with self._lock:
+        self._stats["tensor_set_misses"] += 1
+        self._tensor_sets[key] = tensor_set
+        self._loading.pop(key, None)
+        while len(self._tensor_sets) > self._max_tensor_sets:
+          evicted, _ = self._tensor_sets.popitem(last=False)
+          self._stats["evictions"] += 1
+          logger.info("evicted tensor set %s", evicted[0])
+    return tensor_set[:2]
+
+
+  def evict( self, tensor_path=None ):
+    # drop the resident tensor sets of a directory (any input names), or
+    # all of them; returns how many were dropped
+    with self._lock:
+      keys = [key for key in self._tensor_sets
+              if tensor_path is None or key[0] == os.path.abspath(tensor_path)]
+      for key in keys:
+        del self._tensor_sets[key]
+        logger.info("evicted tensor set %s", key[0])
+      self._stats["evictions"] += len(keys)
+    return len(keys)
+
+
+  def status( self ):
+    with self._lock:
+      return {
+        "tensor_sets": [{"tensor_path": key[0], "input_matrix_names": list(key[1]), "out_of_core": key[2]}
+                        for key in self._tensor_sets],
+        "stats": dict(self._stats),
+      }
+
+
+  def tile( self, request, progress ):
+    # one tiling run: the config file (or the default one) with the
+    # overrides of the request, over a resident tensor set
+    with self._lock:
+      self._stats["requests"] += 1
+    output_path = request["output_path"]
+    os.makedirs(output_path, exist_ok=True)
+    with open(os.path.join(output_path, "log_main.log"), "w") as log_file:
+      # per thread when serving, see _Thread_Stdout
+      redirect = sys.stdout.redirect if isinstance(sys.stdout, _Thread_Stdout) else contextlib.redirect_stdout
+      with redirect(log_file):
+        handler = RunHandler(self._cache, progress)
+        handler.load_config(request.get("config_path", self._default_config_path))
+        handler._config.update(request.get("config", {}))
+        handler._tensors, index_cache = self.tensor_set(handler._config, request["tensor_path"])
+        handler.report_config(index_cache)
+        handler.run(output_path, request.get("verbose", False), request.get("jobs", 1), index_cache=index_cache)
+
+
+  def failed( self ):
+    with self._lock:
+      self._stats["failed"] += 1
+
+
+class _Request_Handler(http.server.BaseHTTPRequestHandler):
+
+  # chunked responses need HTTP/1.1
+  protocol_version = "HTTP/1.1"
+
+
+  def log_message( self, format, *args ):
+    # the client address of a Unix socket is empty, log without it
+    logger.info(format, *args)
+
+
+  def _send_json( self, status, document ):
+    body = (json.dumps(document) + "\n").encode()
+    self.send_response(status)
+    self.send_header("Content-Type", "application/json")
+    self.send_header("Content-Length", str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+
+  def _send_event( self, event, details ):
+    line = (json.dumps(dict(details, event=event), default=str) + "\n").encode()
+    self.wfile.write(f"{len(line):x}\r\n".encode() + line + b"\r\n")
+    self.wfile.flush()
+
+
+  def do_GET( self ):
+    if self.path != "/status":
+      self._send_json(404, {"error": f"unknown path {self.path}"})
+      return
+    self._send_json(200, self.server.service.status())
+
+
+  def do_POST( self ):
+    if self.path not in ["/tile", "/evict"]:
+      self._send_json(404, {"error": f"unknown path {self.path}"})
+      return
+    try:
+      request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+      if self.path == "/evict":
+        self._send_json(200, {"evicted": self.server.service.evict(request.get("tensor_path"))})
+        return
+      missing = [field for field in ["tensor_path", "output_path"] if field not in request]
+      if missing:
+        raise ValueError(f"missing fields: {', '.join(missing)}")
+    except ValueError as error:
+      self._send_json(400, {"error": str(error)})
+      return
+
+    self.send_response(200)
+    self.send_header("Content-Type", "application/x-ndjson")
+    self.send_header("Transfer-Encoding", "chunked")
+    self.end_headers()
+    start = time.perf_counter()
+    self._send_event("accepted", {"output_path": request["output_path"]})
+    try:
+      self.server.service.tile(request, self._send_event)
+      self._send_event("done", {"elapsed_s": time.perf_counter() - start})
+    except SystemExit as error:
+      # the run handler exits on bad inputs (missing files, unknown
+      # algorithms), which must not take the service down
+      self.server.service.failed()
+      self._send_event("error", {"message": f"run stopped with exit code {error.code}, see its log_main.log"})
+    except Exception as error:
+      self.server.service.failed()
+      logger.exception("request failed")
+      self._send_event("error", {"message": f"{type(error).__name__}: {error}"})
+    self.wfile.write(b"0\r\n\r\n")
+
+
+class _Http_Server(socketserver.ThreadingMixIn, http.server.HTTPServer):
+  daemon_threads = True
+  # a compile flow sends bursts of requests, the default backlog is 5
+  request_queue_size = 128
+
+
+class _Unix_Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+  daemon_threads = True
+  request_queue_size = 128
+
+
+def serve( service, port=None, socket_path=None ):
+  # serve until interrupted, on the Unix socket if one is given, else on
+  # the TCP port of localhost
+  sys.stdout = _Thread_Stdout(sys.stdout)
+  if socket_path is not None:
+    if os.path.exists(socket_path):
+      os.remove(socket_path)
+    server = _Unix_Server(socket_path, _Request_Handler)
+    address = socket_path
+  else:
+    server = _Http_Server(("127.0.0.1", port), _Request_Handler)
+    address = f"http://127.0.0.1:{server.server_address[1]}"
+  server.service = service
+  logger.info("tiling service listening on %s", address)
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    server.server_close()
+    if socket_path is not None and os.path.exists(socket_path):
+      os.remove(socket_path)
@@ -0,0 +1,165 @@
+import os
+import json
+import re
+import numpy
+import scipy.sparse
+import sparse
+
+from util import coo2csf
+
+# supported tile output formats (config: tile_output_format)
+#   text:   one file per seg/crd/val array, one entry per line (comal)
+#   npy:    one .npy file per seg/crd/val array
+#   packed: the arrays of all tiles in a single memory-mappable file,
+#           located through a json index of offsets
+tile_output_formats = ["text", "npy", "packed"]
+
+# supported storage formats of a single tile (config: tile_formats)
+#   csf:    seg/crd arrays per mode and the non-zero values
+#   bitmap: the tile shape, one bit per element (row-major, numpy.packbits
+#           order) and the non-zero values
+#   dense:  the tile shape and every value, row-major
+tile_formats = ["csf", "bitmap", "dense"]
+
+
+def tile_footprints(nnzs, areas, element_size):
+  # bytes of a tile (or of arrays of tiles) in every storage format; a
+  # csf non-zero takes its value and about one coordinate
+  nnzs = numpy.asarray(nnzs, dtype=numpy.int64)
+  areas = numpy.asarray(areas, dtype=numpy.int64)
+  return {
+    "csf": 2 * nnzs * element_size,
+    "bitmap": (areas + 7) // 8 + nnzs * element_size,
+    "dense": areas * element_size,
+  }
+
+
+def select_tile_format(nnz, area, element_size, allowed_formats):
+  # the allowed format with the smallest footprint, the first listed on ties
+  footprints = tile_footprints(nnz, area, element_size)
+  return min(allowed_formats, key=lambda tile_format: int(footprints[tile_format]))
+
+
+def tile_arrays(name, tile_format, tile):
+  # (array name, kind, array) of every array of a tile in the given format
+  if tile_format == "csf":
+    pos_dict, crd_dict, data = coo2csf(sparse.COO(tile))
+    arrays = []
+    for dim, seg_array in pos_dict.items():
+      arrays.append(("tensor_" + name + "_mode_" + str(dim) + "_seg", "Segment data for mode " + str(dim), seg_array))
+    for dim, crd_array in crd_dict.items():
+      arrays.append(("tensor_" + name + "_mode_" + str(dim) + "_crd", "Coordinate data for mode " + str(dim), crd_array))
+    arrays.append(("tensor_" + name + "_mode_vals", "Value data", data))
+    return arrays
+  # bitmap and dense are only selected for tiles whose area is within a
+  # small factor of their nnzs, so densifying a sparse one is fine
+  tile = tile.toarray() if scipy.sparse.issparse(tile) else numpy.asarray(tile)
+  arrays = [("tensor_" + name + "_mode_shape", "Shape", numpy.array(tile.shape))]
+  if tile_format == "bitmap":
+    mask = tile != 0
+    arrays.append(("tensor_" + name + "_mode_bitmap", "Bitmap", numpy.packbits(mask, axis=None)))
+    arrays.append(("tensor_" + name + "_mode_vals", "Value data", tile[mask]))
+  else:
+    arrays.append(("tensor_" + name + "_mode_vals", "Value data", tile.ravel()))
+  return arrays
+
+
+def _compact(array, array_name):
+  # seg, crd and shape entries are stored as int32 whenever they fit
+  array = numpy.asarray(array)
+  is_index = array_name.endswith(("_seg", "_crd", "_shape"))
+  if is_index and array.size > 0 and array.max() < 2**31:
+    return array.astype(numpy.int32)
+  return array
+
+
+def _is_tile_array(array_name, name):
+  # whether array_name (or its file name) is one of the arrays of
+  # tile_arrays for tensor name, in any storage format; matched in full,
+  # the arrays of a tensor "A" are also a prefix of those of "A_T"
+  pattern = "tensor_" + re.escape(name) + r"_mode_(\d+_seg|\d+_crd|vals|shape|bitmap)(\.npy)?"
+  return re.fullmatch(pattern, array_name) is not None
+
+
+def _clear_tile_arrays(tile_path, name):
+  # a rewritten tile may come in another storage format, so drop the
+  # arrays it had before
+  for file_name in os.listdir(tile_path):
+    if _is_tile_array(file_name, name):
+      os.remove(os.path.join(tile_path, file_name))
+
+
+def write_tile_text(tile_path, name, arrays, verbose):
+  _clear_tile_arrays(tile_path, name)
+  for array_name, kind, array in arrays:
+    with open(os.path.join(tile_path, array_name), "w") as array_file:
+      array_file.write("".join(str(v) + "\n" for v in array))
+      if verbose:
+        print(f"{kind} of tile {name} saved to {array_file.name}")
+
+
+def write_tile_npy(tile_path, name, arrays, verbose):
+  _clear_tile_arrays(tile_path, name)
+  for array_name, kind, array in arrays:
+    array_file = os.path.join(tile_path, array_name + ".npy")
+    numpy.save(array_file, _compact(array, array_name))
+    if verbose:
+      print(f"{kind} of tile {name} saved to {array_file}")
+
+
+class Packed_Tile_Writer:
+
+  # arrays start on 64-byte boundaries so that every memory-mapped
+  # view is aligned for its dtype
+  alignment = 64
+
+  def __init__(self, output_path, file_name="tiles.bin", index_name="tiles_index.json", append=False):
+    self._output_path = output_path
+    self._file_name = file_name
+    self._index_name = index_name
+    index_path = os.path.join(output_path, index_name)
+    if append and os.path.exists(index_path):
+      # rewritten tiles are appended and their index entries replaced,
+      # the old bytes are left in place (unreferenced)
+      with open(index_path, "r") as index_file:
+        self._index = json.load(index_file)
+      self._file = open(os.path.join(output_path, file_name), "ab")
+      self._offset = self._file.tell()
+    else:
+      self._file = open(os.path.join(output_path, file_name), "wb")
+      self._offset = 0
+      self._index = {"file": file_name, "alignment": self.alignment, "tiles": {}}
+
+  def write(self, tile_name, name, arrays, verbose):
+    tile_index = self._index["tiles"].setdefault(tile_name, {})
+    # a rewritten tile may come in another storage format
+    for array_name in [a for a in tile_index if _is_tile_array(a, name)]:
+      del tile_index[array_name]
+    for array_name, kind, array in arrays:
+      array = numpy.ascontiguousarray(_compact(array, array_name))
+      padding = -self._offset % self.alignment
+      if padding:
+        self._file.write(b"\0" * padding)
+        self._offset += padding
+      tile_index[array_name] = {
+        "offset": self._offset,
+        "dtype": array.dtype.str,
+        "length": int(array.size),
+      }
+      self._file.write(array.tobytes())
+      self._offset += array.nbytes
+      if verbose:
+        print(f"{kind} of tile {name} packed into {self._file.name} at offset {tile_index[array_name]['offset']}")
+
+  def close(self):
+    self._file.close()
+    with open(os.path.join(self._output_path, self._index_name), "w") as index_file:
+      json.dump(self._index, index_file)
+
+
+def read_packed_array(output_path, index, tile_name, array_name):
+  # memory-map one array back out of a packed tile file
+  entry = index["tiles"][tile_name][array_name]
+  return numpy.memmap(os.path.join(output_path, index["file"]), mode="r",
+                      dtype=numpy.dtype(entry["dtype"]), offset=entry["offset"],
+                      shape=(entry["length"],))
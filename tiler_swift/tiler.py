@@ -3,13 +3,25 @@ from model_opal import Model_Opal
 from tiler_qtree import Tiler_Qtree
 from tiler_btree import Tiler_Btree
 from tiler_simple import Tiler_Simple
+from tiler_dp import Tiler_Dp
+from tiler_kdtree import Tiler_Kdtree
+from tiler_matmul import Tiler_Matmul
 
 class Tiler:
 
 
-    def __init__( self, config, tensors ):
+    def __init__( self, config, tensors, model=None, index_cache=None ):
         self._config = config
         self._tensors = tensors
+        # the model (and its estimate cache) is kept across tile() calls,
+        # a warm model can also be handed in by the caller
+        self._model = model
+        # nnz indexes shared with the models of other configs (and the
+        # GLB level model of a two-level tiling)
+        self._index_cache = index_cache if index_cache is not None else {}
+        # GLB super-tiles of the last two-level tiling, see tile_hierarchical
+        self._glb_model = None
+        self.glb_tiles = None
 
     
     def tile_test( self ):
@@ -18,25 +30,79 @@ class Tiler:
         return results
 
 
-    def tile_simple( self, model ):
+    def tile_simple( self, model, rect=None ):
         # for now, only support elementwise operations
         assert self._config['operation'] in ['elementwise-add', 'elementwise-mul']
         ts = Tiler_Simple( self._config, self._tensors, model )
-        return ts.tile()
+        return ts.tile( rect )
 
     
-    def tile_qtree( self, model ):
+    def tile_qtree( self, model, rect=None ):
         # for now, only support elementwise operations
         assert self._config['operation'] in ['elementwise-add', 'elementwise-mul']
         tq = Tiler_Qtree( self._config, self._tensors, model )
-        return tq.tile()
+        return tq.tile( rect )
 
 
-    def tile_btree( self, model ):
+    def tile_btree( self, model, rect=None ):
         # for now, only support elementwise operations
         assert self._config['operation'] in ['elementwise-add', 'elementwise-mul']
         tb = Tiler_Btree( self._config, self._tensors, model )
-        return tb.tile()
+        return tb.tile( rect )
+
+
+    def tile_dp( self, model, rect=None ):
+        # for now, only support elementwise operations
+        assert self._config['operation'] in ['elementwise-add', 'elementwise-mul']
+        td = Tiler_Dp( self._config, self._tensors, model )
+        return td.tile( rect )
+
+
+    def tile_kdtree( self, model, rect=None ):
+        # for now, only support elementwise operations
+        assert self._config['operation'] in ['elementwise-add', 'elementwise-mul']
+        tk = Tiler_Kdtree( self._config, self._tensors, model )
+        return tk.tile( rect )
+
+
+    def tile_matmul( self, model ):
+        assert self._config['operation'] == 'matmul'
+        tm = Tiler_Matmul( self._config, self._tensors, model )
+        return tm.tile()
+
+
+    def tile_hierarchical( self ):
+        # two levels: first partition the tensors into super-tiles that
+        # fit in the GLB with the least off-chip transfer cost, then tile
+        # every super-tile into memory tiles; both levels use the same
+        # tiling algorithm, and the memory tiles of a super-tile are kept
+        # contiguous so that the next GLB load can overlap their compute
+        # for now, only support elementwise operations
+        assert self._config['operation'] in ['elementwise-add', 'elementwise-mul']
+        glb_model = self.build_glb_model()
+        # at the GLB level the fixed cost of a tile is that of its transfer
+        glb_config = dict( self._config, hierarchical_tiling=False,
+                           tile_overhead=self._config.get( 'glb_transfer_overhead', 0 ) )
+        super_tiles = Tiler( config=glb_config, tensors=self._tensors, model=glb_model ).tile()
+        results = []
+        self.glb_tiles = []
+        for super_tile in super_tiles:
+            rect = next( iter( super_tile.values() ) )
+            tiles = self.tile( rect )
+            self.glb_tiles.append( {
+                'rect': super_tile,
+                'tiles': list( range( len( results ), len( results ) + len( tiles ) ) ),
+                'transfer_cost': glb_model.estimate_tile_runtime( rect ),
+            } )
+            results += tiles
+        return results
+
+
+    def estimate_transfer_cost( self ):
+        # total off-chip transfer cost of the last two-level tiling
+        if self.glb_tiles is None:
+            return None
+        return sum( glb_tile['transfer_cost'] for glb_tile in self.glb_tiles )
 
 
     def tile_dynamic_reflexive( self ):
@@ -45,25 +111,81 @@ class Tiler:
         return results
 
 
-    def tile( self ):
+    def build_model( self ):
+        # build the performance model (and its nnz indexes) once
+        if self._model is None:
+            if self._config['performance_model'] == "opal":
+                self._model = Model_Opal( self._config, self._tensors, self._index_cache )
+            else:
+                print(f"Unknown performance model: {self._config['performance_model']}")
+                exit(1)
+        return self._model
 
-        if self._config['performance_model'] == "opal":
-            model = Model_Opal( self._config, self._tensors )
-        else:
-            print(f"Unknown performance model: {self._config['performance_model']}")
-            exit(1)
 
-        if self._config['tiling_algorithm'] == "test":
+    def build_glb_model( self ):
+        # the GLB level model of a two-level tiling, sharing the nnz
+        # indexes of the memory tile model
+        if self._glb_model is None:
+            self._glb_model = Model_Opal( self._config, self._tensors, self._index_cache, level='glb' )
+        return self._glb_model
+
+
+    def model_stats( self ):
+        stats = { 'tiling_algorithm': self._config['tiling_algorithm'] }
+        stats.update( self.build_model().stats() )
+        return stats
+
+
+    def tile( self, rect=None ):
+        # tile the whole tensors, or only the region rect = [x, y, w, h]
+        # of them (e.g. to re-tile the tiles touched by an update)
+
+        model = self.build_model()
+
+        if rect is None and self._config.get('hierarchical_tiling', False):
+            return self.tile_hierarchical()
+        elif self._config['operation'] == 'matmul':
+            # the matmul tiler searches the M, N and K dimensions (and the
+            # order of the tiles), whatever the tiling algorithm
+            assert rect is None, "matmul does not support tiling a region"
+            return self.tile_matmul(model)
+        elif self._config['tiling_algorithm'] == "test":
             return self.tile_test()
         elif self._config['tiling_algorithm'] == "simple":
-            return self.tile_simple(model)
+            return self.tile_simple(model, rect)
         elif self._config['tiling_algorithm'] == "qtree":
-            return self.tile_qtree(model)
+            return self.tile_qtree(model, rect)
         elif self._config['tiling_algorithm'] == "btree":
-            return self.tile_btree(model)
+            return self.tile_btree(model, rect)
+        elif self._config['tiling_algorithm'] == "dp":
+            return self.tile_dp(model, rect)
+        elif self._config['tiling_algorithm'] == "kdtree":
+            return self.tile_kdtree(model, rect)
         elif self._config['tiling_algorithm'] == "dynamic_reflexive":
             return self.tile_dynamic_reflexive()
         else:
             print(f"Unknown tiling algorithm: {self._config['tiling_algorithm']}")
             exit(1)
 
+
+    def estimate_runtime( self, results ):
+        # total estimated runtime of a tiling, the sum of the estimates
+        # of its tiles, or -1 if any of the tiles does not fit
+        if self._config['operation'] == 'matmul':
+            # the loads of the blocks depend on the order of the tiles
+            return self._model.estimate_matmul_runtime( results )
+        total_runtime = 0
+        for pair in results:
+            tile_runtime = self._model.estimate_tile_runtime( next( iter( pair.values() ) ) )
+            if tile_runtime < 0:
+                return -1
+            total_runtime += tile_runtime
+        return total_runtime
+
+
+    def estimate_tile_runtimes( self, results ):
+        # estimated runtime of every tile on its own, -1 for the tiles
+        # that do not fit
+        if self._config['operation'] == 'matmul':
+            return self._model.estimate_matmul_tile_runtimes( results )
+        return [ self._model.estimate_tile_runtime( next( iter( pair.values() ) ) ) for pair in results ]
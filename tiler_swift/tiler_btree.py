@@ -1,4 +1,5 @@
-import numpy
+
+from tree_parallel import explore_subtrees
 
 class Tiler_Btree:
 
@@ -6,37 +7,84 @@ class Tiler_Btree:
         self._config = config
         self._tensors = tensors
         self._model = model
+        # subtrees already tiled by the workers of explore_subtrees
+        self._explored = {}
     
 
-    def _tile_recursive( self, rect ):
+    def _halves( self, rect ):
+        # split along the longer side
         x, y, width, height = rect
+        if width > height:
+            hw = width // 2
+            return [x, y, hw, height], [x + hw, y, width-hw, height]
+        else:
+            hh = height // 2
+            return [x, y, width, hh], [x, y + hh, width, height-hh]
+
+
+    def _children( self, rect ):
+        # halves of an infeasible tile, for the parallel exploration
+        if self._model.estimate_tile_runtime( rect ) < 0:
+            return list( self._halves( rect ) )
+        return []
 
+
+    def _tile_tree( self, rect ):
+        # expand the tree level by level, estimating every node of a level
+        # in one batch: a node that fits is a tile, the others are split in
+        # two halves for the next level
         # assumption: if the tile can have positive runtime estimate,
         # then its runtime must be better than its splits
-        tile_runtime = self._model.estimate_tile_runtime( rect )
-        if tile_runtime < 0:
-            # the tile is infeasible, so we need to split it
-            if width > height:
-                hw = width // 2
-                r1, t1 = self._tile_recursive( [x, y, hw, height] )
-                r2, t2 = self._tile_recursive( [x + hw, y, width-hw, height] )
-                return r1 + r2, t1 + t2
+        nodes = [ list( rect ) ]
+        halves = [ None ]
+        runtimes = [ 0 ]
+        frontier = [ 0 ]
+        while frontier:
+            pending = [ node for node in frontier if tuple( nodes[node] ) not in self._explored ]
+            frontier = []
+            node_runtimes = self._model.estimate_tile_runtimes( [ nodes[node] for node in pending ] )
+            for node, tile_runtime in zip( pending, node_runtimes.tolist() ):
+                if tile_runtime < 0:
+                    # the tile is infeasible, so we need to split it
+                    halves[node] = [ len( nodes ), len( nodes ) + 1 ]
+                    for half in self._halves( nodes[node] ):
+                        nodes.append( half )
+                        halves.append( None )
+                        runtimes.append( 0 )
+                    frontier += halves[node]
+                else:
+                    runtimes[node] = tile_runtime
+
+        # the tiles in depth-first order, first half first
+        run_time_estimate = 0
+        result = []
+        stack = [ 0 ]
+        while stack:
+            node = stack.pop()
+            if tuple( nodes[node] ) in self._explored:
+                explored_runtime, explored_result = self._explored[tuple( nodes[node] )]
+                run_time_estimate += explored_runtime
+                result += explored_result
+            elif halves[node] is not None:
+                stack += reversed( halves[node] )
             else:
-                hh = height // 2
-                r1, t1 = self._tile_recursive( [x, y, width, hh] )
-                r2, t2 = self._tile_recursive( [x, y + hh, width, height-hh] )
-                return r1 + r2, t1 + t2
-        else:
-            result = {}
-            for tensor_name in self._tensors.keys():
-                result[tensor_name] = [x, y, width, height]
-            return tile_runtime, [result]
+                run_time_estimate += runtimes[node]
+                tile = {}
+                for tensor_name in self._tensors.keys():
+                    tile[tensor_name] = list( nodes[node] )
+                result.append( tile )
+        return run_time_estimate, result
 
 
-    def tile( self ):
+    def tile( self, rect=None ):
         assert len(self._tensors) == 2, "only support two input tensors"
-        tensor_name = list(self._tensors.keys())[0]
-        tensor_width = self._tensors[tensor_name].shape[1]
-        tensor_height = self._tensors[tensor_name].shape[0]
-        run_time_estimate, result = self._tile_recursive([0, 0, tensor_width, tensor_height])
+        # the whole tensor, or only the given region of it
+        if rect is None:
+            tensor_name = list(self._tensors.keys())[0]
+            rect = [0, 0, self._tensors[tensor_name].shape[1], self._tensors[tensor_name].shape[0]]
+        # with tree_parallel_jobs, large regions are split among workers
+        self._explored = explore_subtrees( self, rect, self._config.get( 'tree_parallel_jobs', 1 ),
+                                           self._config.get( 'tree_parallel_min_area', 1 << 20 ) )
+        run_time_estimate, result = self._tile_tree( list( rect ) )
+        self._explored = {}
         return result
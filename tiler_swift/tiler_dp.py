@@ -0,0 +1,105 @@
+import math
+
+class Tiler_Dp:
+
+    def __init__( self, config, tensors, model ):
+        self._config = config
+        self._tensors = tensors
+        self._model = model
+        # best (runtime, cut) of every sub-rectangle solved so far
+        self._memo = {}
+
+
+    def _cuts( self, start, length, granularity ):
+        # cut positions strictly inside [start, start+length), aligned
+        # to the cut grid so that sub-rectangles are shared between
+        # different partitions
+        first = ( start // granularity + 1 ) * granularity
+        return range( first, start + length, granularity )
+
+
+    def _solve( self, rect, granularity ):
+        key = ( tuple( rect ), granularity )
+        if key in self._memo:
+            return self._memo[key][0]
+        x, y, width, height = rect
+
+        # a tile that fits is never worth splitting: the output nnzs of
+        # the parts add up to at least the nnzs of the whole tile, and
+        # every part pays tile_overhead again
+        tile_runtime = self._model.estimate_tile_runtime( rect )
+        if tile_runtime >= 0:
+            self._memo[key] = ( tile_runtime, None )
+            return tile_runtime
+
+        x_cuts = self._cuts( x, width, granularity )
+        y_cuts = self._cuts( y, height, granularity )
+        if len( x_cuts ) == 0 and len( y_cuts ) == 0:
+            if granularity == 1:
+                raise ValueError( f'Single element tile {rect} does not fit in the memory tile' )
+            # a single cell of the cut grid that does not fit, so
+            # refine the grid inside this cell only
+            best = ( self._solve( rect, granularity // 2 ), ( 'refine', granularity // 2 ) )
+            self._memo[key] = best
+            return best[0]
+
+        best = ( math.inf, None )
+        for cx in x_cuts:
+            runtime = self._solve( [x, y, cx - x, height], granularity ) \
+                    + self._solve( [cx, y, x + width - cx, height], granularity )
+            if runtime < best[0]:
+                best = ( runtime, ( 'x', cx ) )
+        for cy in y_cuts:
+            runtime = self._solve( [x, y, width, cy - y], granularity ) \
+                    + self._solve( [x, cy, width, y + height - cy], granularity )
+            if runtime < best[0]:
+                best = ( runtime, ( 'y', cy ) )
+        self._memo[key] = best
+        return best[0]
+
+
+    def _collect( self, rect, granularity, results ):
+        # walk the memoized cuts back down to the tiles
+        x, y, width, height = rect
+        _, cut = self._memo[( tuple( rect ), granularity )]
+        if cut is None:
+            result = {}
+            for tensor_name in self._tensors.keys():
+                result[tensor_name] = [x, y, width, height]
+            results.append( result )
+        elif cut[0] == 'refine':
+            self._collect( rect, cut[1], results )
+        elif cut[0] == 'x':
+            cx = cut[1]
+            self._collect( [x, y, cx - x, height], granularity, results )
+            self._collect( [cx, y, x + width - cx, height], granularity, results )
+        else:
+            cy = cut[1]
+            self._collect( [x, y, width, cy - y], granularity, results )
+            self._collect( [x, cy, width, y + height - cy], granularity, results )
+
+
+    def tile( self, rect=None ):
+        assert len(self._tensors) == 2, "only support two input tensors"
+        # the whole tensor, or only the given region of it
+        if rect is None:
+            tensor_name = list(self._tensors.keys())[0]
+            rect = [0, 0, self._tensors[tensor_name].shape[1], self._tensors[tensor_name].shape[0]]
+        rect = list( rect )
+        tensor_width = rect[2]
+        tensor_height = rect[3]
+
+        # cuts are only considered every dp_cut_granularity elements,
+        # the number of subproblems grows with the 4th power of the
+        # number of cut positions, so by default use at most
+        # dp_max_cuts positions along the longer side
+        granularity = self._config.get( 'dp_cut_granularity', 0 )
+        if granularity <= 0:
+            max_cuts = self._config.get( 'dp_max_cuts', 16 )
+            granularity = max( 1, math.ceil( max( tensor_width, tensor_height ) / max_cuts ) )
+
+        self._memo = {}
+        self.estimated_runtime = self._solve( rect, granularity )
+        results = []
+        self._collect( rect, granularity, results )
+        return results
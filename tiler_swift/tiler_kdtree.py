@@ -0,0 +1,113 @@
+class Tiler_Kdtree:
+
+    def __init__( self, config, tensors, model ):
+        self._config = config
+        self._tensors = tensors
+        self._model = model
+        # how to place the cut of an infeasible tile
+        #   balance: split the output nnzs evenly between the two sides
+        #   pack: make the first side as large as the memory tile allows
+        self._split = config.get( 'kdtree_split', 'pack' )
+        assert self._split in ['balance', 'pack'], "kdtree_split must be either 'balance' or 'pack'"
+
+
+    def _part( self, rect, axis, position ):
+        # the first `position` columns (axis 'x') or rows (axis 'y') of rect
+        x, y, width, height = rect
+        if axis == 'x':
+            return [x, y, position, height]
+        else:
+            return [x, y, width, position]
+
+
+    def _first_position( self, rect, axis, predicate ):
+        # smallest position in [1, length) for which predicate holds, or
+        # length if none does; predicate must be monotone in the position,
+        # which holds as the nnzs of a part are prefix sums, and each
+        # probe is O(1) with the nnz index
+        length = rect[2] if axis == 'x' else rect[3]
+        lo = 1
+        hi = length
+        while lo < hi:
+            mid = ( lo + hi ) // 2
+            if predicate( self._part( rect, axis, mid ) ):
+                hi = mid
+            else:
+                lo = mid + 1
+        return lo
+
+
+    def _balanced_position( self, rect, axis ):
+        length = rect[2] if axis == 'x' else rect[3]
+        target = self._model.estimate_output_nnz( rect ) / 2.0
+        position = self._first_position( rect, axis,
+                                         lambda part: self._model.estimate_output_nnz( part ) >= target )
+        position = min( position, length - 1 )
+        # the cut right before may be closer to an even split
+        if position > 1:
+            above = self._model.estimate_output_nnz( self._part( rect, axis, position ) ) - target
+            below = target - self._model.estimate_output_nnz( self._part( rect, axis, position - 1 ) )
+            if below < above:
+                position -= 1
+        return position
+
+
+    def _packed_position( self, rect, axis ):
+        length = rect[2] if axis == 'x' else rect[3]
+        # the first infeasible position, so the one before is the
+        # largest first side that still fits in the memory tile
+        position = self._first_position( rect, axis,
+                                         lambda part: self._model.estimate_tile_runtime( part ) < 0 ) - 1
+        if position < 1:
+            # not even a single column/row fits, fall back to balancing
+            return self._balanced_position( rect, axis )
+        return min( position, length - 1 )
+
+
+    def _tile_iterative( self, rect ):
+        # depth-first over an explicit stack, the first side of a cut
+        # before the second, so the tiles come in the order of a
+        # recursion; pack peels one strip per cut, which would recurse
+        # as deep as there are strips
+        total_runtime = 0
+        results = []
+        stack = [ rect ]
+        while stack:
+            x, y, width, height = stack.pop()
+
+            tile_runtime = self._model.estimate_tile_runtime( [x, y, width, height] )
+            if tile_runtime >= 0:
+                result = {}
+                for tensor_name in self._tensors.keys():
+                    result[tensor_name] = [x, y, width, height]
+                total_runtime += tile_runtime
+                results.append( result )
+                continue
+
+            # cut across the longer side, like the btree tiler, but at the
+            # position chosen from where the non-zeros are
+            if width == 1 and height == 1:
+                raise ValueError( f'Single element tile {[x, y, width, height]} does not fit in the memory tile' )
+            axis = 'x' if width > height or height == 1 else 'y'
+            if self._split == 'pack':
+                position = self._packed_position( [x, y, width, height], axis )
+            else:
+                position = self._balanced_position( [x, y, width, height], axis )
+
+            if axis == 'x':
+                stack.append( [x + position, y, width - position, height] )
+                stack.append( [x, y, position, height] )
+            else:
+                stack.append( [x, y + position, width, height - position] )
+                stack.append( [x, y, width, position] )
+        return total_runtime, results
+
+
+    def tile( self, rect=None ):
+        assert len(self._tensors) == 2, "only support two input tensors"
+        # the whole tensor, or only the given region of it
+        if rect is None:
+            tensor_name = list(self._tensors.keys())[0]
+            rect = [0, 0, self._tensors[tensor_name].shape[1], self._tensors[tensor_name].shape[0]]
+        run_time_estimate, result = self._tile_iterative( list( rect ) )
+        return result
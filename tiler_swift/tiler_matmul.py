@@ -0,0 +1,77 @@
+import itertools
+import math
+
+class Tiler_Matmul:
+
+    def __init__( self, config, tensors, model ):
+        self._config = config
+        self._tensors = tensors
+        self._model = model
+
+
+    def _tile_sizes( self, length ):
+        # tile sizes for a power-of-two number of tiles, from the largest
+        # to the smallest; the search is over three dimensions, so every
+        # ceil(length / k) (as in the simple tiler) would be too many
+        sizes = []
+        num_tiles = 1
+        while True:
+            size = math.ceil( length / num_tiles )
+            if not sizes or size < sizes[-1]:
+                sizes.append( size )
+            if size == 1:
+                return sizes
+            num_tiles *= 2
+
+
+    def _edges( self, length, size ):
+        return list( range( 0, length, size ) ) + [length]
+
+
+    def tile( self ):
+        assert len(self._tensors) == 2, "only support two input tensors"
+        left, right = self._tensors.keys()
+        m, k = self._tensors[left].shape
+        assert self._tensors[right].shape[0] == k, "inner dimensions of the matmul operands differ"
+        n = self._tensors[right].shape[1]
+
+        # grid search over the tile sizes of M, N and K, with the loop
+        # order of the tiles that reuses the loaded blocks the most
+        tile_overhead = self._config['tile_overhead']
+        total_partial_products = self._model.total_partial_products()
+        best = None
+        for tm in self._tile_sizes( m ):
+            m_edges = self._edges( m, tm )
+            for tn in self._tile_sizes( n ):
+                n_edges = self._edges( n, tn )
+                # smaller tn only adds tiles, so once the overheads
+                # alone are worse, stop
+                num_tiles = ( len( m_edges ) - 1 ) * ( len( n_edges ) - 1 )
+                if best is not None and num_tiles * tile_overhead + total_partial_products >= best[0]:
+                    break
+                # the output blocks do not depend on K
+                output_nnzs = self._model.estimate_matmul_output_grid( m_edges, n_edges )
+                if not self._model.fits( output_nnzs ):
+                    continue
+                for tk in self._tile_sizes( k ):
+                    k_edges = self._edges( k, tk )
+                    runtime, order = self._model.estimate_matmul_grid_runtime( m_edges, n_edges, k_edges, output_nnzs )
+                    if runtime >= 0 and ( best is None or runtime < best[0] ):
+                        best = ( runtime, order, m_edges, n_edges, k_edges )
+
+        assert best is not None, "no grid of tiles fits in the memory tile"
+        self.estimated_runtime, order, m_edges, n_edges, k_edges = best
+        edges = { 'm': m_edges, 'n': n_edges, 'k': k_edges }
+
+        # visit the tiles in the loop order (outer to inner)
+        results = []
+        for blocks in itertools.product( *[ range( len( edges[loop] ) - 1 ) for loop in order ] ):
+            block = dict( zip( order, blocks ) )
+            m0, m1 = m_edges[block['m']], m_edges[block['m'] + 1]
+            n0, n1 = n_edges[block['n']], n_edges[block['n'] + 1]
+            k0, k1 = k_edges[block['k']], k_edges[block['k'] + 1]
+            result = {}
+            result[left] = [k0, m0, k1 - k0, m1 - m0]
+            result[right] = [n0, k0, n1 - n0, k1 - k0]
+            results.append( result )
+        return results
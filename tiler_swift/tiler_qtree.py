@@ -1,4 +1,5 @@
-import numpy
+
+from tree_parallel import explore_subtrees
 
 class Tiler_Qtree:
 
@@ -6,167 +7,159 @@ class Tiler_Qtree:
         self._config = config
         self._tensors = tensors
         self._model = model
+        # results of the subtrees explored by pool workers, by rect
+        self._explored = {}
     
 
-    def _tile_recursive( self, rect ):
+    def _quadrants( self, rect ):
+        # +----+----+
+        # | q1 | q2 |
+        # +----+----+
+        # | q3 | q4 |
+        # +----+----+
         x, y, width, height = rect
-
-        # loop through tensors, count the non-zeros in the tile
-        nnzs = {}
-        for tensor_name, tensor in self._tensors.items():
-            tiled_tensor = tensor[y:y+height, x:x+width]
-            nnzs[tensor_name] = numpy.count_nonzero(tiled_tensor)
-
-        # check if the tile fits in the memory tile
-        # TODO: also need to check output
-        # TODO: now hard-coded to 50, need to change
-        tile_runtime = self._model.estimate_tile_runtime( rect )
-        tile_fit_ok = True
-        if tile_runtime == -1:
-            tile_fit_ok = False
-
-        # if the tile fits, return the tile
-        # otherwise, recursively split the tile
-        # TODO: there might be overlaps in the tiles, need to fix
-        if tile_fit_ok:
-            result = {}
-            for tensor_name in self._tensors.keys():
-                result[tensor_name] = [x, y, width, height]
-            return [result], True
+        if width != 1:
+            hw = width // 2
         else:
-            # +----+----+
-            # | q1 | q2 |
-            # +----+----+
-            # | q3 | q4 |
-            # +----+----+
-            if width != 1:
-                hw = width // 2
-            else:
-                hw = 1
-            if height != 1:
-                hh = height // 2
-            else:
-                hh = 1
-            q1, q1_is_leaf = self._tile_recursive( [x,      y,      hw,       hh] )
-            q2, q2_is_leaf = self._tile_recursive( [x + hw, y,      width-hw, hh] )
-            q3, q3_is_leaf = self._tile_recursive( [x,      y + hh, hw,       height-hh] )
-            q4, q4_is_leaf = self._tile_recursive( [x + hw, y + hh, width-hw, height-hh] )
-
+            hw = 1
+        if height != 1:
+            hh = height // 2
+        else:
+            hh = 1
+        return [ [x,      y,      hw,       hh],
+                 [x + hw, y,      width-hw, hh],
+                 [x,      y + hh, hw,       height-hh],
+                 [x + hw, y + hh, width-hw, height-hh] ]
+
+
+    def _children( self, rect ):
+        # the subtrees of rect, none if it fits (see tree_parallel.py)
+        if self._model.estimate_tile_runtime( rect ) == -1:
+            return self._quadrants( rect )
+        return []
+
+
+    def _tile_tree( self, rect ):
+        # expand the tree level by level, estimating every node of a level
+        # (the frontier) in one batch: a node that fits is a leaf tile, the
+        # others are split in quadrants for the next level; then the tiles
+        # of the split nodes are put together from the deepest level up
+        nodes = [ list( rect ) ]
+        quadrants = [ None ]
+        # (tiles, is_leaf) of every node, leaves and split nodes alike
+        results = [ None ]
+        levels = []
+        frontier = [ 0 ]
+        while frontier:
+            levels.append( frontier )
+            pending = []
+            for node in frontier:
+                if tuple( nodes[node] ) in self._explored:
+                    results[node] = self._explored[tuple( nodes[node] )]
+                else:
+                    pending.append( node )
+            frontier = []
+            # check if the tiles fit in the memory tile
+            tile_runtimes = self._model.estimate_tile_runtimes( [ nodes[node] for node in pending ] )
+            for node, tile_runtime in zip( pending, tile_runtimes.tolist() ):
+                if tile_runtime == -1:
+                    quadrants[node] = list( range( len( nodes ), len( nodes ) + 4 ) )
+                    nodes += self._quadrants( nodes[node] )
+                    quadrants += [ None ] * 4
+                    results += [ None ] * 4
+                    frontier += quadrants[node]
+                else:
+                    result = {}
+                    for tensor_name in self._tensors.keys():
+                        result[tensor_name] = list( nodes[node] )
+                    results[node] = ( [result], True )
+
+        for level in reversed( levels ):
+            split = [ node for node in level if results[node] is None ]
             if self._config["qtree_tile_merging"]:
-                q_result = [[q1, q2], [q3, q4]]
-                q_is_leaf = [[q1_is_leaf, q2_is_leaf], [q3_is_leaf, q4_is_leaf]]
-                
-                merged_result = self._merge_tiles(q_result, q_is_leaf)
-
-                return merged_result, False
+                merges = self._merge_candidates( split, quadrants, results )
+                for node in split:
+                    q_result = [ results[quadrant] for quadrant in quadrants[node] ]
+                    results[node] = ( self._merge_tiles( q_result, merges.get( node, {} ) ), False )
             else:
-                return q1 + q2 + q3 + q4, False
-
-            
-
-
-    def _merge_tiles( self, q_result, q_is_leaf ):
+                for node in split:
+                    tiles = []
+                    for quadrant in quadrants[node]:
+                        tiles += results[quadrant][0]
+                    results[node] = ( tiles, False )
+        return results[0]
+
+
+    # quadrant pairs to merge, in the order they are tried: horizontally
+    # first, then vertically (quadrants 0..3 are q1..q4)
+    _merge_pairs = [ ( 0, 1, 'horizontal' ), ( 2, 3, 'horizontal' ),
+                     ( 0, 2, 'vertical' ), ( 1, 3, 'vertical' ) ]
+
+
+    def _merged_rect( self, first, second, merge_direction ):
+        x, y, width, height = first
+        if merge_direction == 'horizontal':
+            # horizontally merging tile should have the same height, and have the same y anchor
+            assert( second[1] == y and second[3] == height )
+            return [x, y, width + second[2], height]
+        # vertically merging tile should have the same width, and have the same x anchor
+        assert( second[0] == x and second[2] == width )
+        return [x, y, width, height + second[3]]
+
+
+    def _merge_candidates( self, split, quadrants, results ):
+        # every merge the split nodes of a level may try, i.e. of two leaf
+        # quadrants, estimated in one batch; returns, per node, the merged
+        # rect of every pair whose merged tile fits in the memory tile
+        candidates = []
+        for node in split:
+            q_result = [ results[quadrant] for quadrant in quadrants[node] ]
+            for pair, ( first, second, merge_direction ) in enumerate( self._merge_pairs ):
+                if q_result[first][1] and q_result[second][1]:
+                    # every tensor shares the same rectangle, so one is enough
+                    rects = [ next( iter( q_result[idx][0][0].values() ) ) for idx in ( first, second ) ]
+                    candidates.append( ( node, pair, self._merged_rect( rects[0], rects[1], merge_direction ) ) )
+        tile_runtimes = self._model.estimate_tile_runtimes( [ rect for _, _, rect in candidates ] )
+        merges = {}
+        for ( node, pair, rect ), tile_runtime in zip( candidates, tile_runtimes.tolist() ):
+            if tile_runtime >= 0:
+                merges.setdefault( node, {} )[pair] = rect
+        return merges
+
+
+    def _merge_tiles( self, q_result, merges ):
         # merge the quadrant if the quadrant is a leaf quadrant (no further qtree tiling)
-        # and if the two leaf quadrant fit in the memory tile
-
-        merged = [[False, False], [False, False]]
+        # and if the two leaf quadrant fit in the memory tile (merges, by pair, see
+        # _merge_candidates); a quadrant merged horizontally is not merged again
+        merged = [False, False, False, False]
         quadrants_after_merge = []
+        for pair, ( first, second, _ ) in enumerate( self._merge_pairs ):
+            if pair in merges and not merged[first] and not merged[second]:
+                merged[first] = True
+                merged[second] = True
+                result = {}
+                for tensor_name in q_result[first][0][0].keys():
+                    result[tensor_name] = list( merges[pair] )
+                quadrants_after_merge.append( result )
 
-        # try merging horizontally first, the merging tiles have to be leaf tiles
-        if q_is_leaf[0][0] and q_is_leaf[0][1]:
-            merge_result = self._try_merge_quadrants([q_result[0][0][0], q_result[0][1][0]], 'horizontal')
-            if merge_result is not None:
-                merged[0][0] = True
-                merged[0][1] = True
-                quadrants_after_merge.append(merge_result)
-        
-        if q_is_leaf[1][0] and q_is_leaf[1][1]:
-            merge_result = self._try_merge_quadrants([q_result[1][0][0], q_result[1][1][0]], 'horizontal')
-            if merge_result is not None:
-                merged[1][0] = True
-                merged[1][1] = True
-                quadrants_after_merge.append(merge_result)
-
-        # try merging veritcally, the merging tiles have to be leaf tiles and have not been merged horizontally
-        if q_is_leaf[0][0] and q_is_leaf[1][0] and not merged[0][0] and not merged[1][0]:
-            merge_result = self._try_merge_quadrants([q_result[0][0][0], q_result[1][0][0]], 'vertical')
-            if merge_result is not None:
-                merged[0][0] = True
-                merged[1][0] = True
-                quadrants_after_merge.append(merge_result)
-        
-        if q_is_leaf[0][1] and q_is_leaf[1][1] and not merged[0][1] and not merged[1][1]:
-            merge_result = self._try_merge_quadrants([q_result[0][1][0], q_result[1][1][0]], 'vertical')
-            if merge_result is not None:
-                merged[0][1] = True
-                merged[1][1] = True
-                quadrants_after_merge.append(merge_result)
-        
         # append the tiles that are not merged to the result list
-        for i in range(2): 
-            for j in range(2):
-                if not merged[i][j]:
-                    quadrants_after_merge += q_result[i][j]
+        for idx in range( 4 ):
+            if not merged[idx]:
+                quadrants_after_merge += q_result[idx][0]
 
         return quadrants_after_merge
 
-    def _try_merge_quadrants(self, quadrant_info, merge_direction):
-        # quadrant_info is a list of quadrants we want to merge
-        # each quadrant is a dictionary indexed by the input tensor name
-        # and stores the quadrant rectangle (x, y, width, height) for each input tensor
-        # merge_direction specify the direction of merging, it's either 'horizontal' or 'vertical'
-        assert (merge_direction == 'horizontal' or merge_direction == 'vertical'), "merge_direction must be either 'horizontal' or 'vertical'"
-
-        # first count the nnzs in the quadrants we are trying to merge 
-        nnz = {}
-        merged_x = 0
-        merged_y = 0
-        merged_width = 0
-        merged_height = 0
-        for idx, quadrant in enumerate(quadrant_info):
-            for tensor_name, tile_rect in quadrant.items():
-                x, y, width, height = tile_rect
-                if idx == 0:
-                    merged_x = x
-                    merged_y = y
-                if merged_height == "horizontal":
-                    assert(y == merged_y and height == merged_height)
-                    merged_width += width
-                elif merged_height == "vertical":
-                    assert(x == merged_x and width == merged_width)
-                    merged_height += height
-
-        # check if the combined quadrant fits in the memory tile
-        # TODO: Po-Han please replace this with the performance model
-        tile_runtime = self._model.estimate_tile_runtime( [merged_x, merged_y, merged_width, merged_height] )
-        fit_ok = tile_runtime >= 0
-        
-        # combine the quadrant if it fits
-        if fit_ok:
-            result = {}
-            for quadrant in quadrant_info:
-                for tensor_name, tile_rect in quadrant.items():
-                    if not tensor_name in result:
-                        result[tensor_name] = tile_rect
-                    else:
-                        if merge_direction == "horizontal":
-                            # horizontally merging tile should have the same height, and have the sam y anchor
-                            assert(tile_rect[1] == result[tensor_name][1] and tile_rect[3] == result[tensor_name][3])
-                            # increment the width to refelct the merge
-                            result[tensor_name][2] += tile_rect[2]
-                        elif merge_direction == "vertical":
-                            # vertically merging tile should have the same width, and have the same x anchor
-                            assert(tile_rect[0] == result[tensor_name][0] and tile_rect[2] == result[tensor_name][2])
-                            result[tensor_name][3] += tile_rect[3]
-            return result
-        else: 
-            return None
-
-
-    def tile( self ):
+
+    def tile( self, rect=None ):
         assert len(self._tensors) == 2, "only support two input tensors"
-        tensor_name = list(self._tensors.keys())[0]
-        tensor_width = self._tensors[tensor_name].shape[1]
-        tensor_height = self._tensors[tensor_name].shape[0]
-        result, _  = self._tile_recursive([0, 0, tensor_width, tensor_height])
+        # the whole tensor, or only the given region of it
+        if rect is None:
+            tensor_name = list(self._tensors.keys())[0]
+            rect = [0, 0, self._tensors[tensor_name].shape[1], self._tensors[tensor_name].shape[0]]
+        # subtrees of large regions are explored in parallel first, when
+        # tree_parallel_jobs is set
+        self._explored = explore_subtrees( self, rect, self._config.get( 'tree_parallel_jobs', 1 ),
+                                           self._config.get( 'tree_parallel_min_area', 1 << 20 ) )
+        result, _  = self._tile_tree( list( rect ) )
+        self._explored = {}
         return result
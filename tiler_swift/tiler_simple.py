@@ -1,3 +1,4 @@
+import math
 import numpy
 
 class Tiler_Simple:
@@ -6,17 +7,18 @@ class Tiler_Simple:
         self._config = config
         self._tensors = tensors
         self._model = model
-    
-    def _create_tile_pairs( self, tile_width, tile_height ):
+
+    def _create_tile_pairs( self, tile_width, tile_height, rect ):
         results = []
-        for x in range(0, self._tensors['A'].shape[1], tile_width):
-            for y in range(0, self._tensors['A'].shape[0], tile_height):
-                if tile_width + x > self._tensors['A'].shape[1]:
-                    tw = self._tensors['A'].shape[1] - x
+        rx, ry, rw, rh = rect
+        for x in range(rx, rx + rw, tile_width):
+            for y in range(ry, ry + rh, tile_height):
+                if tile_width + x > rx + rw:
+                    tw = rx + rw - x
                 else:
                     tw = tile_width
-                if tile_height + y > self._tensors['A'].shape[0]:
-                    th = self._tensors['A'].shape[0] - y
+                if tile_height + y > ry + rh:
+                    th = ry + rh - y
                 else:
                     th = tile_height
                 result = {}
@@ -24,33 +26,74 @@ class Tiler_Simple:
                 result['B'] = [x, y, tw, th]
                 results.append(result)
         return results
-    
-    def _check_if_all_tiles_fit( self, results ):
-        fit_ok = True
-        for result in results:
-            for tensor_name, tensor in self._tensors.items():
-                x, y, w, h = result[tensor_name]
-                tile_runtime = self._model._estimate_tile_runtime_elemadd([x, y, w, h])
-                if tile_runtime == -1:
-                    fit_ok = False
-        return fit_ok
-
-    def tile( self ):
+
+    def _tile_sizes( self, length ):
+        # every tile size that gives a different number of tiles along a
+        # side of the given length, from the largest to the smallest:
+        # ceil(length / k) for k tiles, non-powers of two included
+        sizes = []
+        num_tiles = 1
+        while num_tiles <= length:
+            size = math.ceil(length / num_tiles)
+            sizes.append(size)
+            # jump to the next number of tiles that shrinks the size
+            num_tiles = math.ceil(length / (size - 1)) if size > 1 else length + 1
+        return sizes
+
+    def _estimate_grid( self, tile_width, tile_height, rect ):
+        # estimated runtime of every tile of the grid, all at once
+        rx, ry, rw, rh = rect
+        x_edges = list(range(rx, rx + rw, tile_width)) + [rx + rw]
+        y_edges = list(range(ry, ry + rh, tile_height)) + [ry + rh]
+        return self._model.estimate_grid_runtime(x_edges, y_edges)
+
+    def _grid_capacity( self, tile_width, tile_height, num_columns, num_rows, rect ):
+        # the most nnzs the tiles of the grid can hold and all fit: the
+        # tiles are full size, but for the last column and row
+        last_width = rect[2] - (num_columns - 1) * tile_width
+        last_height = rect[3] - (num_rows - 1) * tile_height
+        capacity = 0
+        for width, columns in [(tile_width, num_columns - 1), (last_width, 1)]:
+            for height, rows in [(tile_height, num_rows - 1), (last_height, 1)]:
+                if columns * rows > 0:
+                    capacity += columns * rows * self._model.tile_capacity(width * height)
+        return capacity
+
+    def tile( self, rect=None ):
         assert len(self._tensors) == 2, "only support two input tensors"
-        tensor_name = list(self._tensors.keys())[0]
-        tensor_width = self._tensors[tensor_name].shape[1]
-        tensor_height = self._tensors[tensor_name].shape[0]
-
-        all_tiles_fit = False
-        tw = tensor_width
-        th = tensor_height
-        while not all_tiles_fit:
-            results = self._create_tile_pairs(tw, th)
-            all_tiles_fit = self._check_if_all_tiles_fit(results)
-            if not all_tiles_fit:
-                if tw != 1:
-                    tw = tw // 2
-                if th != 1:
-                    th = th // 2
+        # the whole tensor, or only the given region of it
+        if rect is None:
+            tensor_name = list(self._tensors.keys())[0]
+            rect = [0, 0, self._tensors[tensor_name].shape[1], self._tensors[tensor_name].shape[0]]
+        tensor_width = rect[2]
+        tensor_height = rect[3]
 
-        return results
+        # every pair of tile width and height is a candidate, the grid
+        # with the lowest total estimated runtime among those that fit
+        # wins. The sizes go from the largest, so the number of tiles only
+        # grows along either loop; grids are skipped without an estimate
+        # when the bounds of the model rule them out: tiles too small to
+        # hold the nnzs, or, once a grid fits, too many tiles to beat it
+        tile_widths = self._tile_sizes(tensor_width)
+        tile_heights = self._tile_sizes(tensor_height)
+        per_tile, fixed, nnzs = self._model.grid_bounds(rect)
+        best = None
+        for tw in tile_widths:
+            num_columns = math.ceil(tensor_width / tw)
+            if best is not None and per_tile * num_columns + fixed >= best[0]:
+                break
+            for th in tile_heights:
+                num_rows = math.ceil(tensor_height / th)
+                if best is not None and per_tile * num_columns * num_rows + fixed >= best[0]:
+                    break
+                if nnzs > self._grid_capacity(tw, th, num_columns, num_rows, rect):
+                    continue
+                grid_runtimes = self._estimate_grid(tw, th, rect)
+                if not numpy.all(grid_runtimes >= 0):
+                    continue
+                total_runtime = int(grid_runtimes.sum())
+                if best is None or total_runtime < best[0]:
+                    best = (total_runtime, tw, th)
+
+        assert best is not None, "no grid of tiles fits in the memory tile"
+        return self._create_tile_pairs(best[1], best[2], rect)
@@ -0,0 +1,191 @@
+import glob
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import yaml
+
+import numpy as np
+import scipy.sparse as sparse
+
+logger = logging.getLogger(__name__)
+
+# config fields that change the tiling decision, anything else (e.g. the
+# tile output format) does not invalidate cached results
+tiling_config_keys = [
+  "tiling_algorithm",
+  "memory_capacity_glb",
+  "memory_capacity_mtile",
+  "element_size",
+  "tile_overhead",
+  "operation",
+  "qtree_tile_merging",
+  "performance_model",
+  "nnz_estimation",
+  "dp_cut_granularity",
+  "dp_max_cuts",
+  "kdtree_split",
+  "hierarchical_tiling",
+  "glb_transfer_overhead",
+  "glb_transfer_cost_per_nnz",
+  "matmul_load_cost_per_nnz",
+  "tile_formats",
+  "bitmap_scan_width",
+  "dense_cost_per_element",
+  "num_units",
+  "schedule_locality",
+  "input_matrix_names",
+]
+
+default_cache_dir = os.path.join(os.path.expanduser("~"), ".cache", "tiler_swift")
+
+# bump on any change to the layout of the entries
+cache_format_version = 1
+
+# sources of the code that the cached results and tiles come from, a
+# change to any of them (e.g. to a model estimate) invalidates the cache
+cached_code_patterns = ["tiler*.py", "model_*.py", "nnz_index.py", "tree_parallel.py",
+                        "scheduler.py", "tile_writer.py", "util.py"]
+
+
+def code_digest():
+  digest = hashlib.sha256(f"format {cache_format_version}".encode())
+  source_dir = os.path.dirname(os.path.abspath(__file__))
+  for pattern in cached_code_patterns:
+    for source_path in sorted(glob.glob(os.path.join(source_dir, pattern))):
+      digest.update(os.path.basename(source_path).encode())
+      with open(source_path, "rb") as f:
+        digest.update(f.read())
+  return digest.hexdigest()
+
+
+def tensor_digest(tensor, digest):
+  # feed the shape, the dtype and the contents of a tensor to the hash,
+  # sparse tensors by their canonical CSR arrays (see load_tensor)
+  if sparse.issparse(tensor):
+    csr = sparse.csr_matrix(tensor)
+    digest.update(f"csr {csr.shape} {csr.dtype}".encode())
+    for array in (csr.indptr, csr.indices, csr.data):
+      digest.update(np.ascontiguousarray(array).data)
+  else:
+    digest.update(f"dense {tensor.shape} {tensor.dtype}".encode())
+    # a block of rows at a time, a memory-mapped tensor is never read
+    # in full (same digest as the whole tensor at once)
+    block_rows = max(1, 2**26 // max(1, tensor.shape[1] * tensor.itemsize))
+    for row in range(0, tensor.shape[0], block_rows):
+      digest.update(np.ascontiguousarray(tensor[row:row + block_rows]).data)
+
+
+class Tiling_Cache:
+
+
+  def __init__( self, cache_dir=default_cache_dir, max_size_mb=1024, with_tiles=False ):
+    # one directory per key with results.yaml, summary.yaml (and any
+    # other yaml output of the tiling, e.g. hierarchy.yaml), and the
+    # tiles (one directory per output format) when with_tiles is set;
+    # the least recently used entries go once the cache is over max_size_mb
+    self._cache_dir = cache_dir
+    self._max_size = max_size_mb * 1024 * 1024
+    self._with_tiles = with_tiles
+    self._code_digest = code_digest()
+
+
+  def key( self, config, tensors ):
+    digest = hashlib.sha256(self._code_digest.encode())
+    tiling_config = {k: config.get(k) for k in tiling_config_keys}
+    digest.update(json.dumps(tiling_config, sort_keys=True).encode())
+    for name in sorted(tensors.keys()):
+      digest.update(name.encode())
+      tensor_digest(tensors[name], digest)
+    return digest.hexdigest()
+
+
+  def _entry_path( self, key ):
+    return os.path.join(self._cache_dir, key)
+
+
+  def load( self, key ):
+    # the cached yaml documents by name ("results", "summary", ...), or
+    # None on a miss
+    entry_path = self._entry_path(key)
+    documents = {}
+    try:
+      for file_name in os.listdir(entry_path):
+        if file_name.endswith(".yaml"):
+          # results of a fine tiling are long, use libyaml when it is there
+          with open(os.path.join(entry_path, file_name), "r") as f:
+            documents[file_name[:-len(".yaml")]] = yaml.load(f, Loader=getattr(yaml, "CSafeLoader", yaml.SafeLoader))
+    except (OSError, yaml.YAMLError):
+      documents = {}
+    if "results" not in documents or "summary" not in documents:
+      logger.info("miss %s", key[:16])
+      return None
+    # the entry mtime is its last use, for the eviction
+    os.utime(entry_path)
+    logger.info("hit %s", key[:16])
+    return documents
+
+
+  def has_tiles( self, key, output_format ):
+    return os.path.isdir(os.path.join(self._entry_path(key), "tiles_" + output_format))
+
+
+  def load_tiles( self, key, output_format, tile_path ):
+    # copy the cached tiles of the format to tile_path, if there are any
+    cached_tile_path = os.path.join(self._entry_path(key), "tiles_" + output_format)
+    if not self._with_tiles or not self.has_tiles(key, output_format):
+      return False
+    shutil.copytree(cached_tile_path, tile_path, dirs_exist_ok=True)
+    return True
+
+
+  def store( self, key, documents, output_format=None, tile_path=None ):
+    # build the entry aside and move it in place in one rename, so that
+    # concurrent runs (e.g. a sweep) never see half an entry
+    os.makedirs(self._cache_dir, exist_ok=True)
+    entry_path = self._entry_path(key)
+    staging_path = tempfile.mkdtemp(prefix=".staging_", dir=self._cache_dir)
+    for name, document in documents.items():
+      with open(os.path.join(staging_path, name + ".yaml"), "w") as f:
+        yaml.dump(document, f)
+    if self._with_tiles and tile_path is not None:
+      if self.has_tiles(key, output_format):
+        shutil.rmtree(staging_path)
+        return
+      # an entry may already exist with the tiles of other formats
+      if os.path.isdir(entry_path):
+        shutil.copytree(entry_path, staging_path, dirs_exist_ok=True)
+      shutil.copytree(tile_path, os.path.join(staging_path, "tiles_" + output_format))
+      shutil.rmtree(entry_path, ignore_errors=True)
+    try:
+      os.rename(staging_path, entry_path)
+    except OSError:
+      # someone else stored the same entry first
+      shutil.rmtree(staging_path, ignore_errors=True)
+    self.evict()
+
+
+  def _entry_size( self, entry_path ):
+    size = 0
+    for root, dirs, files in os.walk(entry_path):
+      for file_name in files:
+        size += os.path.getsize(os.path.join(root, file_name))
+    return size
+
+
+  def evict( self ):
+    # drop the least recently used entries until the cache fits
+    entries = []
+    for entry in os.scandir(self._cache_dir):
+      if entry.is_dir() and not entry.name.startswith(".staging_"):
+        entries.append((entry.stat().st_mtime, entry.path, self._entry_size(entry.path)))
+    entries.sort()
+    total_size = sum(size for _, _, size in entries)
+    for _, entry_path, size in entries:
+      if total_size <= self._max_size:
+        break
+      shutil.rmtree(entry_path, ignore_errors=True)
+      total_size -= size
+      logger.info("evicted %s", os.path.basename(entry_path)[:16])
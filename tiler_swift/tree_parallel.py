@@ -0,0 +1,54 @@
+import concurrent.futures
+import multiprocessing
+import threading
+
+# tiler of the running exploration, inherited by the forked workers: the
+# pages of its tensors, nnz indexes and model are shared copy-on-write
+# with the parent instead of being pickled to every worker
+_tree_tiler = None
+
+
+def _explore( rect ):
+    return _tree_tiler._tile_tree( rect )
+
+
+def explore_subtrees( tiler, rect, jobs, min_area ):
+    # explore the subtrees of a qtree/btree tiling of rect in a pool of
+    # `jobs` forked workers; regions under min_area stay sequential.
+    # The parent splits the nodes larger than the task area the same way
+    # the tiler does (tiler._children, none for a tile that fits), and
+    # hands the smaller ones to the workers whole. Returns the result
+    # of every explored subtree by its rect, for _tile_tree to pick up
+    # instead of expanding it, so that the merges and the order of the
+    # tiles are exactly those of the sequential exploration.
+    # Only the main thread of the main process forks: forking from a
+    # thread (e.g. a request of the tiling service) may copy a lock held
+    # by another thread and deadlock the workers, and a process that is
+    # a worker already (e.g. of a sweep) would multiply the processes.
+    area = rect[2] * rect[3]
+    if jobs <= 1 or area < min_area or "fork" not in multiprocessing.get_all_start_methods():
+        return {}
+    if threading.current_thread() is not threading.main_thread() or multiprocessing.parent_process() is not None:
+        return {}
+    # a few tasks per worker, to balance the uneven subtrees
+    task_area = max( min_area, area / ( 4 * jobs ) )
+    tasks = []
+    frontier = [ list( rect ) ]
+    while frontier:
+        node = frontier.pop()
+        if node[2] * node[3] <= task_area:
+            tasks.append( node )
+        else:
+            frontier += tiler._children( node )
+    # the largest subtrees first
+    tasks.sort( key=lambda node: -node[2] * node[3] )
+
+    global _tree_tiler
+    _tree_tiler = tiler
+    try:
+        context = multiprocessing.get_context( "fork" )
+        with concurrent.futures.ProcessPoolExecutor( max_workers=jobs, mp_context=context ) as executor:
+            results = list( executor.map( _explore, tasks ) )
+    finally:
+        _tree_tiler = None
+    return { tuple( task ): result for task, result in zip( tasks, results ) }
@@ -1,49 +1,99 @@
+import os
+import resource
+import sys
+import scipy.io
 import scipy.sparse as sparse
 import numpy as np
+import sparse as pydata_sparse
+
+def tensor_file(tensor_path, name):
+  # the file load_tensor reads the tensor from, or None if there is none
+  for extension in ["npy", "npz", "mtx"]:
+    file_path = os.path.join(tensor_path, f"{name}.{extension}")
+    if os.path.exists(file_path):
+      return file_path
+  return None
+
+
+def load_tensor(tensor_path, name, mmap=False):
+  # dense tensors are stored as .npy, sparse ones as .npz (scipy CSR/CSC,
+  # or pydata sparse COO) or .mtx (matrix market); sparse tensors are kept
+  # as CSR so that memory scales with the nnzs, not with rows x cols;
+  # with mmap, dense tensors are memory-mapped (read-only) instead of
+  # read, so they can be larger than the memory
+  file_path = tensor_file(tensor_path, name)
+  if file_path is None:
+    return None
+  elif file_path.endswith(".npy"):
+    return np.load(file_path, mmap_mode="r" if mmap else None)
+  elif file_path.endswith(".npz"):
+    with np.load(file_path) as npz:
+      is_scipy = 'format' in npz.files
+    if is_scipy:
+      tensor = sparse.load_npz(file_path)
+    else:
+      tensor = pydata_sparse.load_npz(file_path).to_scipy_sparse()
+  else:
+    tensor = scipy.io.mmread(file_path)
+  tensor = sparse.csr_matrix(tensor)
+  # canonical CSR: sorted column indices, no duplicates, no explicit zeros
+  tensor.sum_duplicates()
+  tensor.eliminate_zeros()
+  return tensor
+
+
+def count_nnz(tensor):
+  if sparse.issparse(tensor):
+    return tensor.nnz
+  else:
+    return np.count_nonzero(tensor)
+
+
+def peak_memory_mb(children=False):
+  # peak resident set size of this process (or the largest of its
+  # terminated children), ru_maxrss is in KB on linux but bytes on macos
+  who = resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF
+  peak = resource.getrusage(who).ru_maxrss
+  if sys.platform == "darwin":
+    peak = peak / 1024
+  return peak / 1024
+
 
 def coo2csf(coo_matrix):
-  # The number of values in the tensor
-  num_values = len(coo_matrix.data)
   n_dim = len(coo_matrix.shape)
 
-  crd_dict = {} 
+  crd_dict = {}
   pos_dict = {}
   if coo_matrix.nnz == 0:
     # this is a completely empty matrix
     for dim in range(0, n_dim):
-      crd_dict[dim] = [0]
-      pos_dict[dim] = [0, 1]
-    data_array = [0]
+      crd_dict[dim] = np.array([0])
+      pos_dict[dim] = np.array([0, 1])
+    data_array = np.array([0])
     return pos_dict, crd_dict, data_array
-  else: 
-    cur_fiber_length = [num_values]
-    next_level_fiber_length = [1]
-    for dim in range(0, n_dim):
-      idx = 0
-      for fiber_length in cur_fiber_length:
-        pos_count = 1
-        for i in range(0, fiber_length):
-          # The very first element in the crd/seg output
-          if (idx == 0):
-            crd_dict[dim] = [coo_matrix.coords[dim][idx]]
-            pos_dict[dim] = [0]
-          else:
-            # Beginning of a fiber
-            if (i == 0):
-              crd_dict[dim].append(coo_matrix.coords[dim][idx])
-            else:
-              if (crd_dict[dim][-1] != coo_matrix.coords[dim][idx]):
-                crd_dict[dim].append(coo_matrix.coords[dim][idx])
-                next_level_fiber_length.append(1)
-                pos_count += 1
-              else:
-                next_level_fiber_length[-1] += 1
-          idx += 1
-        pos_dict[dim].append(pos_count + pos_dict[dim][-1])
-        pos_count = 1
-      cur_fiber_length = next_level_fiber_length
-      next_level_fiber_length = [1]
-  return pos_dict, crd_dict, coo_matrix.data
-
 
+  coords = np.asarray(coo_matrix.coords)
+  data = np.asarray(coo_matrix.data)
+  # fibers are read off runs of equal coordinates below, so the
+  # non-zeros have to be in lexicographic (row-major) order
+  keys = np.ravel_multi_index(tuple(coords), coo_matrix.shape)
+  if np.any(keys[1:] < keys[:-1]):
+    order = np.argsort(keys, kind='stable')
+    coords = coords[:, order]
+    data = data[order]
 
+  # The number of values in the tensor
+  num_values = len(data)
+  # a non-zero starts a new fiber at level dim if its coordinate
+  # in dim, or in any level above, differs from the previous one
+  new_fiber = np.zeros(num_values, dtype=bool)
+  new_fiber[0] = True
+  parent_starts = np.array([0])
+  for dim in range(0, n_dim):
+    new_fiber[1:] |= coords[dim][1:] != coords[dim][:-1]
+    starts = np.flatnonzero(new_fiber)
+    crd_dict[dim] = coords[dim][starts]
+    # every fiber of the level above is a run of fibers in this level
+    pos_dict[dim] = np.append(np.searchsorted(starts, parent_starts), len(starts))
+    parent_starts = starts
+  return pos_dict, crd_dict, data
@@ -1,9 +1,11 @@
 import argparse
 import numpy as np
+import scipy.sparse
 import yaml
-from scipy.sparse import csr_matrix
-from PIL import Image, ImageDraw
-from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+
+from nnz_index import Nnz_Index
+from util import load_tensor
 
 class Visualizer:
     def __init__(self, tensor, tiling, output_img_file):
@@ -12,78 +14,151 @@ class Visualizer:
         self._output_img_file = output_img_file
         self._border_width = 1
         self._dot_width = 3
-    
+        # "raster": one dot per non-zero, "heatmap": one pixel per block
+        # of elements, shaded by its nnzs, "auto": raster unless the
+        # image would be larger than max_resolution on a side
+        self._mode = "auto"
+        self._max_resolution = 4096
+
 
     def set_border_width(self, border_width):
         self._border_width = border_width
-    
+
 
     def set_dot_width(self, dot_width):
         self._dot_width = dot_width
-    
-    
-    def visualize(self):
-        # Create a sparse matrix for demonstration purposes
+
+
+    def set_mode(self, mode):
+        assert mode in ["auto", "raster", "heatmap"], "mode must be 'auto', 'raster' or 'heatmap'"
+        self._mode = mode
+
+
+    def set_max_resolution(self, max_resolution):
+        self._max_resolution = max_resolution
+
+
+    def _paint_segments(self, img, fixed, start, end, axis, color):
+        # paint the straight segments from start to end (inclusive) at
+        # the fixed rows (axis 1) or columns (axis 0), one slice each
+        for f, s, e in zip(fixed.tolist(), np.maximum(start, 0).tolist(), end.tolist()):
+            if axis == 1:
+                img[f, s:e + 1] = color
+            else:
+                img[s:e + 1, f] = color
+
+
+    def _paint_borders(self, img, x1, y1, x2, y2, width, color):
+        # outlines of the rectangles [x1, y1, x2, y2], `width` pixels
+        # thick inwards, same as PIL's ImageDraw.rectangle
+        for k in range(width):
+            self._paint_segments(img, np.concatenate([y1 + k, y2 - k]), np.concatenate([x1, x1]),
+                                 np.concatenate([x2, x2]), 1, color)
+            self._paint_segments(img, np.concatenate([x1 + k, x2 - k]), np.concatenate([y1, y1]),
+                                 np.concatenate([y2, y2]), 0, color)
+
+
+    def _tile_rects(self):
+        rects = np.array([tiling['A'] for tiling in self._tiling], dtype=np.int64).reshape(-1, 4)
+        return rects[:, 0], rects[:, 1], rects[:, 2], rects[:, 3]
+
+
+    def _raster(self):
         nrows, ncols = self._tensor.shape
+        pitch = self._dot_width + self._border_width
 
         # Create a new image with white background
         img_rows = (nrows * self._dot_width) + ((nrows + 1) * self._border_width)
         img_cols = (ncols * self._dot_width) + ((ncols + 1) * self._border_width)
-        img = Image.new('RGB', (img_cols, img_rows), 'white')
+        img = np.full((img_rows, img_cols, 3), 255, dtype=np.uint8)
+
+        # a black dot per non-zero, one array assignment per pixel of the dot
+        rows, cols = self._tensor.nonzero()
+        im_y = self._border_width + pitch * np.asarray(rows, dtype=np.int64)
+        im_x = self._border_width + pitch * np.asarray(cols, dtype=np.int64)
+        for dy in range(self._dot_width):
+            for dx in range(self._dot_width):
+                img[im_y + dy, im_x + dx] = 0
 
-        # Create a 3x3 black block
-        block_size = self._dot_width
-        black_block = Image.new('RGB', (block_size, block_size), 'black')
+        # Draw the borders based on the tiling result
+        x, y, w, h = self._tile_rects()
+        self._paint_borders(img, self._border_width + pitch * x - 1, self._border_width + pitch * y - 1,
+                            self._border_width + pitch * (x + w) - 1, self._border_width + pitch * (y + h) - 1,
+                            self._border_width, (255, 0, 0))
+        return img
 
-        # Function to paste a 3x3 block
-        def paste_block(y, x):
-            im_x = self._border_width + (self._dot_width + self._border_width) * x
-            im_y = self._border_width + (self._dot_width + self._border_width) * y
-            img.paste(black_block, (im_x, im_y))
 
-        # get the non-zero coordinates using numpy nonzero function in the form of (col, row)
-        non_zero_positions = np.transpose(self._tensor.nonzero())
+    def _block_counts(self, x_edges, y_edges, block_bytes=2**26):
+        # nnzs of every block of the grid; a dense (e.g. memory-mapped)
+        # tensor is read a band of block rows at a time and counted as it
+        # goes, rather than indexed (a summed-area table is as large as
+        # the tensor itself)
+        if scipy.sparse.issparse(self._tensor):
+            return Nnz_Index(self._tensor).grid_counts(x_edges, y_edges)
+        ncols = self._tensor.shape[1]
+        band_blocks = max(1, block_bytes // max(1, (y_edges[1] - y_edges[0]) * ncols * self._tensor.itemsize))
+        counts = []
+        for i in range(0, len(y_edges) - 1, band_blocks):
+            edges = y_edges[i:i + band_blocks + 1]
+            band = np.asarray(self._tensor[edges[0]:edges[-1]]) != 0
+            row_counts = np.add.reduceat(band, x_edges[:-1], axis=1, dtype=np.int64)
+            counts.append(np.add.reduceat(row_counts, edges[:-1] - edges[0], axis=0))
+        return np.concatenate(counts)
 
-        # Paste the 3x3 blocks for non-zero elements in parallel
-        with ThreadPoolExecutor() as executor:
-            executor.map(lambda pos: paste_block(*pos), non_zero_positions)
-        
-        # Draw the borders based on the tiling result
-        draw = ImageDraw.Draw(img)
-        for tiling in self._tiling:
-            x, y, w, h = tiling['A']
-            x1 = self._border_width + (self._dot_width + self._border_width) * x - 1
-            y1 = self._border_width + (self._dot_width + self._border_width) * y - 1
-            x2 = self._border_width + (self._dot_width + self._border_width) * (x + w) - 1
-            y2 = self._border_width + (self._dot_width + self._border_width) * (y + h) - 1
-            draw.rectangle([x1, y1, x2, y2], outline='red', width=self._border_width)
-        
-        # Resize the image to 500 pixels wide, maintaining the aspect ratio
-        # new_width = 500
-        # aspect_ratio = img.height / img.width
-        # new_height = int(new_width * aspect_ratio)
-        # img_resized = img.resize((new_width, new_height), Image.LANCZOS)
-
-        # Save the resized image
-        img.save(self._output_img_file)
+
+    def _heatmap(self):
+        # one pixel per block of elements, at most max_resolution pixels
+        # on a side, darker with more nnzs in the block (log scale, the
+        # densest block is black); memory scales with the nnzs and the
+        # image, not with the matrix
+        nrows, ncols = self._tensor.shape
+        block = max(1, -(-max(nrows, ncols) // self._max_resolution))
+        x_edges = np.append(np.arange(0, ncols, block), ncols)
+        y_edges = np.append(np.arange(0, nrows, block), nrows)
+        counts = self._block_counts(x_edges, y_edges)
+        shade = np.log1p(counts) / max(np.log1p(counts.max()), 1e-12)
+        img = np.repeat((255 * (1 - shade)).astype(np.uint8)[:, :, None], 3, axis=2)
+
+        # tile borders, one pixel wide, on the pixels of their edges
+        x, y, w, h = self._tile_rects()
+        self._paint_borders(img, x // block, y // block,
+                            np.minimum((x + w - 1) // block, len(x_edges) - 2),
+                            np.minimum((y + h - 1) // block, len(y_edges) - 2), 1, (255, 0, 0))
+        return img
+
+
+    def visualize(self):
+        nrows, ncols = self._tensor.shape
+        mode = self._mode
+        if mode == "auto":
+            pitch = self._dot_width + self._border_width
+            fits = max(nrows, ncols) * pitch + self._border_width <= self._max_resolution
+            mode = "raster" if fits else "heatmap"
+        img = self._raster() if mode == "raster" else self._heatmap()
+
+        # Save the image
+        Image.fromarray(img).save(self._output_img_file)
+        print(f"Tiling visualization ({mode}, {img.shape[1]}x{img.shape[0]}) saved to {self._output_img_file}")
 
 if __name__ == "__main__":
-  
+
     # Parse command line
     p = argparse.ArgumentParser()
     p.add_argument( "-r", "--result-path", type=str, default="./output/results.yaml" )
     p.add_argument( "-t", "--tensor-path", type=str, default="./benchmarks/n4c6-b1" )
     p.add_argument( "-n", "--tensor-name", type=str, default="A" )
     p.add_argument( "-o", "--output-path", type=str, default="./output.png" )
+    p.add_argument( "-m", "--mode", type=str, default="auto", choices=["auto", "raster", "heatmap"] )
+    p.add_argument( "--max-resolution", type=int, default=4096 )
     opts = p.parse_args()
 
-    # load the tensor
-    tensor_file = f"{opts.tensor_path}/{opts.tensor_name}.npy"
-    tensor = np.load(tensor_file)
+    # load the tensor, dense (.npy, memory-mapped so that a large one is
+    # only read a band at a time) or sparse (.npz/.mtx)
+    tensor = load_tensor(opts.tensor_path, opts.tensor_name, mmap=True)
 
     # load the tiling result yaml file
     with open(opts.result_path, 'r') as f:
-      tiling = yaml.safe_load(f)
+      tiling = yaml.load(f, Loader=getattr(yaml, "CSafeLoader", yaml.SafeLoader))
 
     # Create a visualizer
     visualizer = Visualizer(tensor, tiling, opts.output_path)
@@ -92,5 +167,9 @@ if __name__ == "__main__":
     visualizer.set_border_width(1)
     visualizer.set_dot_width(3)
 
+    # Raster the non-zeros, or a heatmap of them for large matrices
+    visualizer.set_mode(opts.mode)
+    visualizer.set_max_resolution(opts.max_resolution)
+
     # Visualize the sparse matrix
     visualizer.visualize()